@@ -1,14 +1,831 @@
+import bisect
+import hashlib
+import io
 import json
+import mmap
+import os
+import pickle
 import re
+import signal
+import threading
+import time
 
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
 
-class PyCAudit:
-    def __init__(self, config, template):
+
+def normalize_config(config):
+    # Let's normalize the newlines in the config so we only have to deal with one type, \n.
+    # Also, convert the config to lowercase for uniformity
+    config = config.lower().replace('\r\n', '\n').replace('\r', '\n')
+    # Someone thought it would be a good idea to let some of the lines in the Cisco configurations end
+    #  in whitespace.  Let's try to remove those.
+    return re.sub(r'\s+\n', '\n', config)
+
+
+def copy_result(result):
+    # A copy of the findings of an audit that can be changed without changing the findings kept elsewhere.
+    #  Findings only hold strings, and tuples or lists of strings for rules with several groups.
+    return [{name: list(value) if isinstance(value, list) else value for name, value in finding.items()}
+            for finding in result]
+
+
+def split_config_lines(lines):
+    # Turn an iterable of raw lines, each with or without its line ending, into the lines of the text they make
+    #  up split on \n, the same lines config.split('\n') gives for the whole text.  Lines without a line ending
+    #  are taken to be followed by a newline when another line comes after them.
+    ended = False
+    for raw_line in lines:
+        if isinstance(raw_line, bytes):
+            raw_line = raw_line.decode('utf-8', 'replace')
+        raw_line = raw_line.replace('\r\n', '\n').replace('\r', '\n')
+        ended = raw_line.endswith('\n')
+        if ended:
+            raw_line = raw_line[:-1]
+        for line in raw_line.split('\n'):
+            yield line
+    # A line ending on the very last line leaves an empty line behind it
+    if ended:
+        yield ''
+
+
+def normalize_lines(lines):
+    # Normalize a config one line at a time, yielding exactly the lines of normalize_config() on the whole text.
+    #  Trailing whitespace is removed from every line but the last, and lines holding nothing but whitespace are
+    #  dropped, except for a blank first line which is left behind empty.
+    first = True
+    pending = None
+    for line in split_config_lines(lines):
+        line = line.lower()
+        if pending is not None:
+            if pending and not pending.isspace():
+                yield pending.rstrip()
+            elif first:
+                yield ''
+            first = False
+        pending = line
+    # The last line keeps its trailing whitespace, there is no newline after it
+    if pending is not None:
+        yield pending
+
+
+def iter_config_lines(source):
+    # Yield the raw lines of a config from a file path, a file object or an iterable of lines.  Files named by
+    #  path are memory mapped and decoded a line at a time, so the whole file is never read into memory.
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as config_file:
+            # Empty files can't be mapped, and have no lines anyway
+            if os.fstat(config_file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ) as config_map:
+                for line in iter(config_map.readline, b''):
+                    yield line
+    else:
+        for line in source:
+            yield line
+
+
+def load_config(source):
+    # Read, normalize and index a config from a file path, a file object or an iterable of lines, one line at a
+    #  time.  The result can be audited like a config string, without normalizing or indexing it again.
+    return ConfigIndex.from_lines(normalize_lines(iter_config_lines(source)))
+
+
+def literal_prefix(pattern):
+    # Return the text every match of pattern must start with, or '' if that can't be known.  The pattern is parsed
+    #  the same way re.compile() does, so escapes are understood and alternation inside a group is no obstacle.
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return ''
+    # Case insensitive patterns can start with text that isn't in the pattern
+    if parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ''
+    prefix = []
+    for position, (op, av) in enumerate(parsed):
+        # A ^ at the very start doesn't change what the match starts with
+        if position == 0 and op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+            continue
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(chr(av))
+    prefix = ''.join(prefix)
+    # Only prefixes starting on a non-whitespace character can be found through the index
+    if prefix[:1].isspace():
+        return ''
+    return prefix
+
+
+def literal_text(pattern):
+    # Return (text, wildcards) if pattern is nothing but plain text and unescaped dots, otherwise None.  text is the
+    #  line the pattern was written for, with every . standing for itself, so it always matches text.  wildcards are
+    #  the positions of the dots that can match other characters too, like the dots of the addresses in an access
+    #  list.
+    if not re.search(r'[\\^$*+?{}\[\]|()]', pattern):
+        return pattern, tuple(position for position, character in enumerate(pattern) if character == '.')
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return None
+    if parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None
+    if any(op not in (sre_constants.LITERAL, sre_constants.ANY) for op, av in parsed):
+        return None
+    return (''.join(chr(av) if op == sre_constants.LITERAL else '.' for op, av in parsed),
+            tuple(position for position, (op, av) in enumerate(parsed) if op == sre_constants.ANY))
+
+
+def required_literals(pattern):
+    # Return the literal text every match of pattern has to contain, as a tuple of strings.  Text that doesn't
+    #  contain all of them can't match, and finding that out with a substring search is much cheaper than running
+    #  the regular expression.
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return ()
+    if parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ()
+    literals = []
+    _required_literals(parsed, literals)
+    return tuple(sorted(set(literals), key=len, reverse=True))
+
+
+def _required_literals(parsed, literals):
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = []
+        # Groups and repeats that have to match at least once must contain their own literals too
+        if op == sre_constants.SUBPATTERN:
+            if not av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                _required_literals(av[-1], literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            _required_literals(av[2], literals)
+    if run:
+        literals.append(''.join(run))
+
+
+def single_line_pattern(pattern):
+    # Return True if no match of pattern can run past the end of a line.  Anything that could match a newline,
+    #  like negated character classes, whitespace or unknown escapes and lookarounds, is assumed to.
+    return not re.search(r'[\x00-\x1f]|\[\^|\(\?(?!:)|\\(?![SdwbB]|[^a-zA-Z0-9])', pattern)
+
+
+def nested_quantifier(pattern):
+    # Return True if pattern repeats, without limit, something that is itself repeated, like (a+)+ or (\w+\s?)*.
+    #  These patterns can take exponential time to fail a match on a long line.
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return False
+    return _nested_quantifier(parsed, False)
+
+
+def _nested_quantifier(parsed, inside_unbounded_repeat):
+    for op, av in parsed:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, subpattern = av
+            if high > 1 and inside_unbounded_repeat:
+                return True
+            if _nested_quantifier(subpattern, inside_unbounded_repeat or high == sre_constants.MAXREPEAT):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _nested_quantifier(av[-1], inside_unbounded_repeat):
+                return True
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                if _nested_quantifier(branch, inside_unbounded_repeat):
+                    return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _nested_quantifier(av[1], inside_unbounded_repeat):
+                return True
+    return False
+
+
+def lint_pattern(pattern, kind):
+    # Return a list of (issue, suggestion) pairs for a pattern from the template.  kind is 'criteria' for
+    #  patterns searched for anywhere in the config or block, 'rule' for block rules and 'sub-rule' for sub-rules,
+    #  which are both anchored to the start of a line, and 'ordered sub-rule' for the sub-rules of == blocks,
+    #  which have to match a whole line.  suggestion is a rewritten pattern, or None.
+    warnings = []
+    if nested_quantifier(pattern):
+        warnings.append(('nested quantifiers can backtrack catastrophically on long lines', None))
+
+    leading = pattern.startswith('.*')
+    trailing = pattern.endswith('.*') and not pattern.endswith('\\.*') and len(pattern) > 2
+    if kind == 'criteria' and (leading or trailing):
+        # Criteria are searched for, a .* at either end can only cost time
+        suggestion = pattern
+        if leading:
+            suggestion = suggestion[2:]
+        if trailing and suggestion.endswith('.*'):
+            suggestion = suggestion[:-2]
+        warnings.append(('leading or trailing .* is redundant when searching', suggestion or None))
+    elif kind == 'sub-rule' and trailing and not leading:
+        warnings.append(('trailing .* is redundant, sub-rules only have to match the start of a line',
+                         pattern[:-2]))
+
+    # Sub-rules are only anchored by the ^ they are compiled with
+    if kind in ('rule', 'sub-rule') and not literal_prefix('^' + pattern if kind == 'sub-rule' else pattern):
+        # Without a literal start, every line has to be tried instead of only those starting with the right command.
+        #  Only the template's author knows which command that is, so there's no rewrite to suggest.
+        warnings.append(('no literal text at the start, every line of the config has to be tried', None))
+    return warnings
+
+
+class PatternTimeout(Exception):
+    def __init__(self, kind, section, pattern, timeout):
+        super().__init__('{} {!r} in section {!r} took longer than {} seconds'.format(kind, pattern, section, timeout))
+        self.kind = kind
+        self.section = section
+        self.pattern = pattern
+        self.timeout = timeout
+
+    def finding(self):
+        # The timeout as it is reported in the audit results
+        return {
+            'type': 'error',
+            'section': self.section,
+            'Template_Value': self.pattern,
+            'Config_Value': 'Evaluating {} took longer than {} seconds'.format(self.kind, self.timeout)
+        }
+
+
+class AuditObserver:
+    # Receives events from an audit.  Pass an instance to audit() to see what the audit is doing, every method
+    #  does nothing unless overridden.
+    def evaluating(self, kind, section, pattern):
+        # A pattern from the template is about to be evaluated
+        pass
+
+    def evaluated(self, kind, section, pattern, matches, seconds):
+        # A pattern from the template was evaluated.  kind is one of 'device_criteria', 'section_criteria',
+        #  'repeat_criteria', 'block_criteria', 'rule', 'rule_lookup', 'sub-rule' or 'ordered sub-rule'.  matches is
+        #  the number of matches found and seconds the time the evaluation took.
+        pass
+
+    def message(self, text):
+        # Diagnostic messages about the audit
+        pass
+
+
+class AuditProfiler(AuditObserver):
+    # Collects the number of evaluations, matches and total time of every pattern in the template, to find the
+    #  patterns an audit spends its time on.  The same profiler can be passed to many audits to add them up.
+    def __init__(self):
+        # (kind, section, pattern) -> [evaluations, matches, seconds]
+        self.stats = {}
+
+    def evaluated(self, kind, section, pattern, matches, seconds):
+        stats = self.stats.get((kind, section, pattern))
+        if stats is None:
+            stats = self.stats[(kind, section, pattern)] = [0, 0, 0.0]
+        stats[0] += 1
+        stats[1] += matches
+        stats[2] += seconds
+
+    def report(self, limit=None):
+        # Return the stats of each pattern, most expensive first
+        report = [{
+            'kind': kind,
+            'section': section,
+            'pattern': pattern,
+            'evaluations': evaluations,
+            'matches': matches,
+            'seconds': seconds
+        } for (kind, section, pattern), (evaluations, matches, seconds) in self.stats.items()]
+        report.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return report[:limit] if limit else report
+
+    def format_report(self, limit=20):
+        lines = ['{:>10} {:>8} {:>10}  {:<16} {:<20} {}'.format(
+            'seconds', 'evals', 'matches', 'kind', 'section', 'pattern')]
+        for entry in self.report(limit):
+            lines.append('{:>10.6f} {:>8} {:>10}  {:<16} {:<20} {}'.format(
+                entry['seconds'], entry['evaluations'], entry['matches'], entry['kind'], entry['section'],
+                entry['pattern']))
+        return '\n'.join(lines)
+
+
+class PatternWatchdog(AuditObserver):
+    # Limits how long any single pattern evaluation may take, passing every event on to observer.  A timer ticks
+    #  on the process' CPU time, and if the pattern being evaluated has run longer than timeout seconds the tick
+    #  raises PatternTimeout, which interrupts the regex engine.  Signals are only delivered to the main thread,
+    #  so the limit is only enforced there, and only on platforms with setitimer().
+    def __init__(self, timeout, observer=None):
+        self.timeout = timeout
+        self.observer = observer
+        self.current = None
+        self.previous_handler = None
+        self.armed = False
+
+    def evaluating(self, kind, section, pattern):
+        self.current = (kind, section, pattern, time.perf_counter())
+        if self.observer is not None:
+            self.observer.evaluating(kind, section, pattern)
+
+    def evaluated(self, kind, section, pattern, matches, seconds):
+        self.current = None
+        if self.observer is not None:
+            self.observer.evaluated(kind, section, pattern, matches, seconds)
+
+    def message(self, text):
+        if self.observer is not None:
+            self.observer.message(text)
+
+    def tick(self, signum, frame):
+        current = self.current
+        if current is not None and time.perf_counter() - current[3] > self.timeout:
+            self.current = None
+            raise PatternTimeout(current[0], current[1], current[2], self.timeout)
+
+    def __enter__(self):
+        if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+            interval = max(min(self.timeout / 4, 0.1), 0.001)
+            self.previous_handler = signal.signal(signal.SIGVTALRM, self.tick)
+            signal.setitimer(signal.ITIMER_VIRTUAL, interval, interval)
+            self.armed = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.armed:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            signal.signal(signal.SIGVTALRM, self.previous_handler)
+            self.armed = False
+
+
+def observed_search(observer, kind, section, compiled, text, memo=None, literals=()):
+    # Return whether compiled.search(text) finds a match, reported to observer when there is one.  When a memo
+    #  dict is given, a pattern already searched for in the same text isn't evaluated again.  literals are the
+    #  required_literals() of the pattern, text missing any of them can't match so the pattern isn't evaluated.
+    if memo is not None:
+        key = (compiled.pattern, compiled.flags, text)
+        found = memo.get(key)
+        if found is not None:
+            return found
+    if any(literal not in text for literal in literals):
+        found = False
+    elif observer is None:
+        found = compiled.search(text) is not None
+    else:
+        observer.evaluating(kind, section, compiled.pattern)
+        start = time.perf_counter()
+        found = compiled.search(text) is not None
+        observer.evaluated(kind, section, compiled.pattern, 1 if found else 0, time.perf_counter() - start)
+    if memo is not None:
+        memo[key] = found
+    return found
+
+
+class ConfigIndex:
+    # A normalized device config parsed once into its top level lines, each with the indented child lines
+    #  that belong to it, and an index of the top level lines by their first token (interface, ntp, logging, ...).
+    #  Rules with a known literal prefix only have to be tried against the lines that can start a match
+    #  instead of scanning the whole config.
+    def __init__(self, device_config, lines=None):
+        # lines can be given instead of splitting device_config, see from_lines()
+        self.config = device_config
+        # Start offset of each top level line -> offset where its block ends
+        self.blocks = {}
+        # Start offset of each block that has been matched -> stripped lines of the block
+        self.block_lines = {}
+        # First token -> start offsets of the top level lines beginning with it, in config order
+        self.tokens = {}
+        self.prefix_candidates = {}
+        # Results of the evaluations done against this config, so templates sharing patterns (or a template
+        #  repeating one) only evaluate them once per device
+        self.memo = {}
+
+        block_start = None
+        block_end = None
+        offset = 0
+        for line in device_config.split('\n') if lines is None else lines:
+            if line.startswith(' ') and block_start is not None:
+                # A child line of the current block, the same lines the block regex would pick up
+                block_end = offset + len(line)
+            else:
+                if block_start is not None:
+                    self.blocks[block_start] = block_end
+                    block_start = None
+                if line and not line[0].isspace():
+                    block_start = offset
+                    block_end = offset + len(line)
+                    self.tokens.setdefault(line.split(' ', 1)[0], []).append(offset)
+            offset += len(line) + 1
+        if block_start is not None:
+            self.blocks[block_start] = block_end
+
+    @classmethod
+    def from_lines(cls, lines):
+        # Build the index from an iterable of normalized lines, indexing each line as it arrives and adding it
+        #  to the config text.  Only the text is kept, not the individual lines.
+        config_text = io.StringIO()
+
+        def collect():
+            for line_number, line in enumerate(lines):
+                if line_number:
+                    config_text.write('\n')
+                config_text.write(line)
+                yield line
+
+        config_index = cls('', collect())
+        config_index.config = config_text.getvalue()
+        return config_index
+
+    def candidates(self, prefix):
+        # Start offsets of the top level lines beginning with prefix
+        if prefix not in self.prefix_candidates:
+            if ' ' in prefix:
+                offsets = self.tokens.get(prefix.split(' ', 1)[0], [])
+            else:
+                offsets = sorted(offset for token, token_offsets in self.tokens.items() if token.startswith(prefix)
+                                 for offset in token_offsets)
+            self.prefix_candidates[prefix] = [offset for offset in offsets
+                                              if self.config.startswith(prefix, offset)]
+        return self.prefix_candidates[prefix]
+
+    def block_texts(self, prefix):
+        # The text of the config blocks starting on the candidate lines for prefix, in config order
+        return [self.config[offset:self.blocks[offset]] for offset in self.candidates(prefix)]
+
+    def find_blocks(self, pattern, prefix):
+        # Equivalent to pattern.findall(config), returning (entry, lines) pairs where lines are the stripped lines
+        #  of the matched config block.  pattern must be anchored to the start of a line, so when the literal
+        #  prefix of the rule is known only the candidate lines need to be tried.
+        key = ('blocks', pattern.pattern, pattern.flags)
+        config_blocks = self.memo.get(key)
+        if config_blocks is None:
+            config_blocks = self.memo[key] = self._find_blocks(pattern, prefix)
+        return config_blocks
+
+    def _find_blocks(self, pattern, prefix):
+        if prefix:
+            matches = []
+            end = 0
+            for offset in self.candidates(prefix):
+                # findall doesn't return overlapping matches
+                if offset < end:
+                    continue
+                match = pattern.match(self.config, offset)
+                if match:
+                    matches.append(match)
+                    end = match.end()
+        else:
+            matches = pattern.finditer(self.config)
+
+        config_blocks = []
+        for match in matches:
+            entry = match.group(1) if pattern.groups == 1 else match.groups('')
+            # The lines of an indexed block are split once, however many rules match it
+            start = match.start(1)
+            if self.blocks.get(start) == match.end(1):
+                lines = self.block_lines.get(start)
+                if lines is None:
+                    lines = self.block_lines[start] = [line.strip() for line in match.group(1).split('\n')]
+            else:
+                lines = [line.strip() for line in match.group(1).split('\n')]
+            config_blocks.append((entry, lines))
+        return config_blocks
+
+
+class SubRuleMatcher:
+    # Checks all the sub-rules of a template block against the lines of a config block in a single pass.
+    #  Sub-rules are anchored to the start of the line, so the ones with a literal prefix are filed under the first
+    #  token of that prefix and each line is only checked against the sub-rules that could match it.
+    def __init__(self, sub_rules):
+        self.count = len(sub_rules)
+        # Identifies the set of sub-rules, matchers built from the same sub-rules give the same matches
+        self.patterns = tuple(compiled.pattern for sub_rule, sub_rule_type, compiled in sub_rules)
+        # First token -> sub-rules whose prefix contains that whole token
+        self.by_token = {}
+        # Sub-rules whose prefix ends part way through the first token, or that have no literal prefix at all
+        self.unindexed = []
+        for index, (sub_rule, sub_rule_type, compiled) in enumerate(sub_rules):
+            # The prefix of the compiled pattern, alternation in the sub-rule leaves later branches unanchored
+            prefix = literal_prefix(compiled.pattern)
+            if ' ' in prefix:
+                self.by_token.setdefault(prefix.split(' ', 1)[0], []).append((index, prefix, compiled))
+            else:
+                self.unindexed.append((index, prefix, compiled))
+
+    def match(self, lines, observer=None, section=''):
+        # Return a list with, for each sub-rule, whether any of the lines matched it
+        if observer is not None:
+            return self.match_observed(lines, observer, section)
+        matched = [False] * self.count
+        remaining = self.count
+        for line in lines:
+            for candidates in (self.by_token.get(line.split(' ', 1)[0], ()), self.unindexed):
+                for index, prefix, compiled in candidates:
+                    if not matched[index] and line.startswith(prefix) and compiled.search(line):
+                        matched[index] = True
+                        remaining -= 1
+            # Stop as soon as every sub-rule has been found
+            if not remaining:
+                break
+        return matched
+
+    def match_observed(self, lines, observer, section):
+        # The same as match(), reporting every sub-rule evaluation to observer
+        matched = [False] * self.count
+        remaining = self.count
+        for line in lines:
+            for candidates in (self.by_token.get(line.split(' ', 1)[0], ()), self.unindexed):
+                for index, prefix, compiled in candidates:
+                    if not matched[index] and line.startswith(prefix):
+                        observer.evaluating('sub-rule', section, compiled.pattern[1:])
+                        start = time.perf_counter()
+                        found = compiled.search(line)
+                        # Report the sub-rule as written, without the ^ it was compiled with
+                        observer.evaluated('sub-rule', section, compiled.pattern[1:], 1 if found else 0,
+                                           time.perf_counter() - start)
+                        if found:
+                            matched[index] = True
+                            remaining -= 1
+            if not remaining:
+                break
+        return matched
+
+
+class OrderedBlockMatcher:
+    # Checks the lines of a config block against the sub-rules of an == template block, which must match the lines
+    #  one for one, in order, with nothing extra.  Each sub-rule has to match a whole line.  A line is paired with
+    #  an unpaired sub-rule written for exactly that line if there is one, and otherwise with an unpaired sub-rule
+    #  matching it.  Either way the first one after the sub-rule paired with the line before is preferred, and
+    #  failing that the earliest one, so a block that is in order with lines missing or added is paired up in step.
+    #  Sub-rules of plain text and dots are looked up by the line itself, the others are only tried against the
+    #  lines starting with the first token of their literal prefix.  A line is only reported as extra once every
+    #  unpaired sub-rule that could match it has been tried.
+
+    def __init__(self, sub_rules):
+        # sub_rules are (sub_rule, compiled) pairs, the ^ the sub-rules are compiled with makes no difference to a
+        #  pattern that has to match the whole line
+        self.sub_rules = [sub_rule for sub_rule, compiled in sub_rules]
+        self.patterns = tuple(self.sub_rules)
+        self.compiled = [compiled for sub_rule, compiled in sub_rules]
+        # Lists of sub-rules in template order.  Every way of looking sub-rules up below leads to one of these.
+        self.lists = []
+        # Line -> list of the sub-rules written for exactly that line, see literal_text()
+        self.literal = {}
+        # Line length -> positions of the dots that can match anything -> the line with those positions as dots ->
+        #  list of the sub-rules written for such a line
+        self.shapes = {}
+        # First token -> list of the sub-rules whose prefix contains that whole token
+        self.by_token = {}
+        # The list of sub-rules whose prefix ends part way through the first token, or that have no literal prefix
+        self.unindexed = None
+        # Sub-rule -> (list, position in that list) for every list the sub-rule is in
+        self.positions = [[] for sub_rule in self.sub_rules]
+        for index, sub_rule in enumerate(self.sub_rules):
+            text = literal_text(sub_rule)
+            if text is not None:
+                text, wildcards = text
+                self.file(self.literal, text, index)
+                if wildcards:
+                    self.file(self.shapes.setdefault(len(text), {}).setdefault(wildcards, {}), text, index)
+                continue
+            prefix = literal_prefix(sub_rule)
+            if ' ' in prefix:
+                self.file(self.by_token, prefix.split(' ', 1)[0], index)
+            else:
+                if self.unindexed is None:
+                    self.unindexed = self.new_list()
+                self.add(self.unindexed, index)
+
+    def new_list(self):
+        self.lists.append([])
+        return len(self.lists) - 1
+
+    def add(self, list_id, index):
+        self.positions[index].append((list_id, len(self.lists[list_id])))
+        self.lists[list_id].append(index)
+
+    def file(self, lists, key, index):
+        list_id = lists.get(key)
+        if list_id is None:
+            list_id = lists[key] = self.new_list()
+        self.add(list_id, index)
+
+    def match(self, lines, observer=None, section=''):
+        # Return (missing, extra, out_of_order): the indexes of the sub-rules no line matched, the indexes of the
+        #  lines no sub-rule matched and the indexes of the sub-rules matched by a line in the wrong place
+        compiled = self.compiled
+        if observer is None:
+            def matches(index, line):
+                return compiled[index].fullmatch(line) is not None
+        else:
+            def matches(index, line):
+                observer.evaluating('ordered sub-rule', section, self.sub_rules[index])
+                start = time.perf_counter()
+                found = compiled[index].fullmatch(line) is not None
+                observer.evaluated('ordered sub-rule', section, self.sub_rules[index], 1 if found else 0,
+                                   time.perf_counter() - start)
+                return found
+
+        # Most blocks are either right or only a few lines off, check the lines in step first
+        if len(lines) == len(compiled) and all(matches(index, line) for index, line in enumerate(lines)):
+            return [], [], []
+
+        lists = self.lists
+        # For each list, links from each position to the next unpaired one (see next_unpaired()), so the sub-rules
+        #  paired already aren't looked at again.  Made the first time a list is needed.
+        skips = {}
+
+        def links(list_id):
+            list_links = skips.get(list_id)
+            if list_links is None:
+                list_links = skips[list_id] = list(range(len(lists[list_id]) + 1))
+            return list_links
+
+        def first(list_id, position, stop, line):
+            # The first unpaired sub-rule of the list from position on and before sub-rule stop that matches line,
+            #  or None.  line is None for lists of sub-rules already known to match.
+            candidates = lists[list_id]
+            list_links = links(list_id)
+            position = next_unpaired(list_links, position)
+            while position < len(candidates) and candidates[position] < stop:
+                index = candidates[position]
+                if line is None or matches(index, line):
+                    return index
+                position = next_unpaired(list_links, position + 1)
+            return None
+
+        def find(searches, after):
+            # searches are (list, line) pairs.  Return the first unpaired sub-rule from after on that matches in
+            #  any of them, or failing that the earliest one before it.
+            best = None
+            for list_id, line in searches:
+                found = first(list_id, bisect.bisect_left(lists[list_id], after),
+                              len(compiled) if best is None else best, line)
+                if found is not None:
+                    best = found
+            if best is not None:
+                return best
+            for list_id, line in searches:
+                found = first(list_id, 0, after if best is None else best, line)
+                if found is not None:
+                    best = found
+            return best
+
+        # The sub-rule paired with each line, in line order, and the lines nothing matched
+        pairs = []
+        extra = []
+        for line_number, line in enumerate(lines):
+            after = pairs[-1] + 1 if pairs else 0
+            best = None
+            list_id = self.literal.get(line)
+            if list_id is not None:
+                best = find([(list_id, None)], after)
+            if best is None:
+                searches = []
+                # Sub-rules whose dots stand for other characters in this line, which match it without being tried
+                for wildcards, texts in self.shapes.get(len(line), {}).items():
+                    characters = list(line)
+                    for position in wildcards:
+                        characters[position] = '.'
+                    list_id = texts.get(''.join(characters))
+                    if list_id is not None:
+                        searches.append((list_id, None))
+                for list_id in (self.by_token.get(line.split(' ', 1)[0]), self.unindexed):
+                    if list_id is not None:
+                        searches.append((list_id, line))
+                if searches:
+                    best = find(searches, after)
+            if best is None:
+                extra.append(line_number)
+                continue
+            pairs.append(best)
+            for list_id, position in self.positions[best]:
+                links(list_id)[position] = position + 1
+
+        paired = set(pairs)
+        missing = [index for index in range(len(compiled)) if index not in paired]
+        in_order = set(longest_increasing(pairs))
+        out_of_order = sorted(index for index in pairs if index not in in_order)
+        return missing, extra, out_of_order
+
+
+def next_unpaired(links, position):
+    # Follow links from position to the first position that links to itself, shortening the path on the way so
+    #  runs of paired positions are only stepped over once
+    while links[position] != position:
+        links[position] = links[links[position]]
+        position = links[position]
+    return position
+
+
+def longest_increasing(values):
+    # Return the longest strictly increasing subsequence of values, in O(n log n).  The values that aren't part of
+    #  it are the fewest that have to move to put the rest in order.
+    # tails[length - 1] is the position of the smallest value ending an increasing subsequence of that length
+    tails = []
+    tail_values = []
+    previous = [None] * len(values)
+    for position, value in enumerate(values):
+        length = bisect.bisect_left(tail_values, value)
+        previous[position] = tails[length - 1] if length else None
+        if length == len(tails):
+            tails.append(position)
+            tail_values.append(value)
+        else:
+            tails[length] = position
+            tail_values[length] = value
+    subsequence = []
+    position = tails[-1] if tails else None
+    while position is not None:
+        subsequence.append(values[position])
+        position = previous[position]
+    subsequence.reverse()
+    return subsequence
+
+
+# A compiled template saved by CompiledTemplate.save() starts with ARTIFACT_MAGIC, the ARTIFACT_VERSION it was written
+#  by and the sha256 of the template text it was compiled from.  Bump the version whenever what a CompiledTemplate
+#  keeps changes, so files saved by older versions are compiled again instead of being loaded.
+ARTIFACT_MAGIC = b'PYCAUDIT'
+ARTIFACT_VERSION = 3
+
+
+def template_text_hash(template):
+    # Identifies the exact text of a template, unlike template_hash which ignores comments and formatting
+    return hashlib.sha256(template.encode('utf-8', 'surrogatepass')).digest()
+
+
+def load_template(path, artifact=None):
+    # Compile the template in the file at path.  If artifact is given, it is the path of a compiled template saved
+    #  from an earlier run, which is loaded instead of parsing the template again when it was compiled from the same
+    #  text, and is saved again when it wasn't.
+    with open(path, encoding='utf-8') as template_file:
+        template = template_file.read()
+    if artifact is None:
+        return CompiledTemplate(template)
+    compiled = CompiledTemplate.load(artifact, template)
+    if compiled is None:
+        compiled = CompiledTemplate(template)
+        try:
+            compiled.save(artifact)
+        except OSError:
+            # Nowhere to keep it, it will be compiled again next time
+            pass
+    return compiled
+
+
+class CompiledTemplate:
+    # A template that has been parsed and had every pattern compiled exactly once.  A single
+    #  CompiledTemplate can be shared by any number of audits: it is never modified by audit(), so it
+    #  is safe to use from several threads at once, and it can be pickled to hand to worker processes.
+    def __init__(self, template):
         self.template_original = template
-        self.config = config
         self.template_string = None
-        self.result = []
         self.template = self.parse_template()
+        # Identifies the parsed template, comments and formatting don't change it
+        self.template_hash = hashlib.sha256(json.dumps(self.template, sort_keys=True).encode()).hexdigest()
+        self.sections = self.compile_template()
+        # Patterns in the template that are likely to be slow, see lint()
+        self.warnings = self.lint()
+
+    def save(self, path):
+        # Save the compiled template to path, so later runs can load() it instead of parsing the template again
+        data = b''.join([ARTIFACT_MAGIC, ARTIFACT_VERSION.to_bytes(4, 'big'),
+                         template_text_hash(self.template_original),
+                         pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)])
+        # Write to a temporary file first so a reader never sees a partially written template
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as artifact_file:
+            artifact_file.write(data)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, template=None):
+        # Load a compiled template saved by save(), with a single read of the file.  Returns None if there is no
+        #  such file, if it was saved by another version or, when the template text is given, if it was compiled
+        #  from different text.  Only load files you wrote yourself, they are unpickled.
+        try:
+            with open(path, 'rb') as artifact_file:
+                data = artifact_file.read()
+        except OSError:
+            return None
+        header = len(ARTIFACT_MAGIC)
+        if data[:header] != ARTIFACT_MAGIC or data[header:header + 4] != ARTIFACT_VERSION.to_bytes(4, 'big'):
+            return None
+        text_hash = data[header + 4:header + 36]
+        if template is not None and text_hash != template_text_hash(template):
+            return None
+        try:
+            compiled = pickle.loads(memoryview(data)[header + 36:])
+        except Exception:
+            return None
+        if not isinstance(compiled, cls):
+            return None
+        return compiled
 
     def parse_template(self):
         # Initialize template dictionary
@@ -99,12 +916,18 @@ class PyCAudit:
                     # Each rule is either a positive or negative match
                     #   Positive: True - Must be in the config
                     #   Negative: False - Must not appear in config
+                    # == blocks have to match the config block line for line, in order, with nothing extra
+                    exact = line.startswith("==")
+                    if exact:
+                        line = line[2:]
                     if line.startswith("--"):
                         line = line[2:]
                         rule_type = False
                     else:
                         rule_type = True
                     current_block["rule"] = (line, rule_type)
+                    if exact:
+                        current_block["exact"] = True
                     current_block["block_positive_criteria"] = []
                     current_block["block_negative_criteria"] = []
                     current_block["sub-rules"] = []
@@ -138,238 +961,505 @@ class PyCAudit:
 
         return template
 
-    def audit(self):
-        # Set Debugging to True or False
-        debug = False
-        self.result = []
+    def lint(self):
+        # Check every pattern in the template for constructs that make audits slow, returning a list of warnings
+        #  with a suggested rewrite of the pattern where there is one.  A pattern used several times in a section
+        #  is only reported once.
+        warnings = []
+        reported = set()
+
+        def warn(section, kind, pattern, issue, suggestion):
+            if (section, kind, pattern, issue) in reported:
+                return
+            reported.add((section, kind, pattern, issue))
+            warnings.append({
+                'section': section,
+                'kind': kind,
+                'pattern': pattern,
+                'issue': issue,
+                'suggestion': suggestion
+            })
+
+        def check(section, kind, pattern):
+            for issue, suggestion in lint_pattern(pattern, kind):
+                warn(section, kind, pattern, issue, suggestion)
+
+        template = self.template
+        for pattern in list(template["device_positive_criteria"].values()) + list(
+                template["device_negative_criteria"].values()):
+            check('', 'criteria', pattern)
+        for section, content in template["sections"].items():
+            for criteria_type in ["section_positive_criteria", "section_negative_criteria",
+                                  "section_positive_repeat_criteria", "section_negative_repeat_criteria"]:
+                for criteria in content[criteria_type]:
+                    check(section, 'criteria', criteria['pattern'])
+            for block in content["blocks"]:
+                if block is None:
+                    continue
+                check(section, 'rule', block["rule"][0])
+                for criteria in block["block_positive_criteria"] + block["block_negative_criteria"]:
+                    check(section, 'criteria', criteria['pattern'])
+                for sub_rule in block["sub-rules"]:
+                    check(section, 'ordered sub-rule' if block.get("exact") else 'sub-rule', sub_rule[0].strip())
+                    if block.get("exact") and not sub_rule[1]:
+                        warn(section, 'ordered sub-rule', sub_rule[0].strip(),
+                             '-- sub-rules are ignored in == blocks, any line not in the template is already extra',
+                             None)
+        return warnings
+
+    def compile_template(self):
+        # Build a list of sections mirroring self.template["sections"], with every regular expression the
+        #  audit needs already compiled.  Only 'config' criteria are evaluated by audit(), so those are the
+        #  only criteria compiled here.
+        template = self.template
+
+        # The text each criteria pattern requires, checked before the pattern is evaluated
+        self.criteria_literals = {}
+
+        def compile_criteria(criteria_list):
+            compiled_criteria = [re.compile(criteria['pattern'], re.MULTILINE)
+                                 for criteria in criteria_list if criteria['property'] == "config"]
+            for compiled in compiled_criteria:
+                self.criteria_literals[compiled.pattern] = required_literals(compiled.pattern)
+            return compiled_criteria
+
+        self.device_positive_criteria = [
+            (criteria, pattern, re.compile(pattern, re.MULTILINE))
+            for criteria, pattern in template["device_positive_criteria"].items() if criteria == "config"]
+        self.device_negative_criteria = [
+            (criteria, pattern, re.compile(pattern, re.MULTILINE))
+            for criteria, pattern in template["device_negative_criteria"].items() if criteria == "config"]
+        for criteria, pattern, compiled in self.device_positive_criteria + self.device_negative_criteria:
+            self.criteria_literals[compiled.pattern] = required_literals(pattern)
+
+        sections = []
+        for section, content in template["sections"].items():
+            compiled_section = {
+                "section": section,
+                "section_positive_criteria": compile_criteria(content["section_positive_criteria"]),
+                "section_negative_criteria": compile_criteria(content["section_negative_criteria"]),
+                "section_positive_repeat_criteria": compile_criteria(content["section_positive_repeat_criteria"]),
+                "section_negative_repeat_criteria": compile_criteria(content["section_negative_repeat_criteria"]),
+                "blocks": []
+            }
+            for block in content["blocks"]:
+                # A section without any rules leaves an empty block behind, there is nothing to audit in it
+                if block is None:
+                    continue
+                rule = block["rule"][0]
+                sub_rules = [(sub_rule[0].strip(), sub_rule[1],
+                              re.compile('^{}'.format(sub_rule[0].strip()), re.MULTILINE))
+                             for sub_rule in block["sub-rules"]]
+                compiled_section["blocks"].append({
+                    "rule": rule,
+                    "rule_type": block["rule"][1],
+                    # Finds every config block (top level line plus its indented children) matching the rule
+                    "block_pattern": re.compile('^((?:{}$)(?:(?:\n .*))*)'.format(rule), re.MULTILINE),
+                    # Config blocks can only start on the lines beginning with this text
+                    "prefix": literal_prefix(rule),
+                    # The rule can't match past the end of a line, so its config blocks are exactly the indexed ones
+                    "single_line": single_line_pattern(rule),
+                    # Extracts the line that matched the rule from a config block
+                    "rule_pattern": re.compile('.*{}.*'.format(rule), re.MULTILINE),
+                    "block_positive_criteria": compile_criteria(block["block_positive_criteria"]),
+                    "block_negative_criteria": compile_criteria(block["block_negative_criteria"]),
+                    "sub-rules": sub_rules,
+                    # == blocks are checked line for line instead.  Any line not in the template is extra, so only
+                    #  the positive sub-rules matter.
+                    "sub_rule_matcher": SubRuleMatcher(sub_rules) if not block.get("exact") else None,
+                    "ordered_matcher": OrderedBlockMatcher(
+                        [(sub_rule, compiled) for sub_rule, sub_rule_type, compiled in sub_rules if sub_rule_type])
+                    if block.get("exact") else None
+                })
+            sections.append(compiled_section)
+
+        return sections
+
+    def audit(self, config, observer=None, pattern_timeout=None):
+        # observer, an AuditObserver, is told about every pattern evaluated during the audit.  A pattern that takes
+        #  longer than pattern_timeout seconds to evaluate is abandoned and reported as an 'error' finding.
+        return self._audit_state(config, observer=observer, pattern_timeout=pattern_timeout)[0]
+
+    def audit_stream(self, source, observer=None, pattern_timeout=None):
+        # Audit a config read a line at a time from a file path, a file object or an iterable of lines
+        return self.audit(load_config(source), observer, pattern_timeout)
+
+    def audit_state(self, config, previous=None, normalized=False, observer=None, pattern_timeout=None):
+        # Audit config, returning the findings along with the state needed to audit the same device again
+        #  incrementally.  previous is the state returned by the last audit of this device, template blocks that
+        #  only look at config blocks which haven't changed since then reuse their findings from that audit.
+        #  config can also be a ConfigIndex from load_config().  Set normalized if config is a string that has
+        #  already been through normalize_config().  The findings returned are a copy of the ones kept in the
+        #  state, so changing them doesn't change what the next audit reuses.
+        result, state = self._audit_state(config, previous, normalized, observer, pattern_timeout)
+        return copy_result(result), state
+
+    def _audit_state(self, config, previous=None, normalized=False, observer=None, pattern_timeout=None):
+        if pattern_timeout:
+            with PatternWatchdog(pattern_timeout, observer) as watchdog:
+                return self._audit_state(config, previous, normalized, watchdog)
+
+        result = []
+        state = {
+            "template_hash": self.template_hash,
+            "config": None,
+            "sections": None,
+            "result": result
+        }
 
         ################################### BEGIN Harvesting Running Configuration #######################################
         # Get the device name, full config, software version, and decide which req_block_X to use
         # You'll need to read your config file into "device_config"
-        device_config = self.config
+        #  A config from load_config() has already been normalized and indexed
+        if isinstance(config, ConfigIndex):
+            config_index = config
+            device_config = config.config
+            normalized = True
+            memo = config.memo
+        else:
+            config_index = None
+            device_config = config
+            memo = {}
 
         # Couldn't get live or baseline config, log error and move on
         if (not device_config) or (device_config is None) or (device_config == ''):
-            self.result.append({
+            result.append({
                 'type': 'error',
                 'section': '',
                 'Template_Value': '',
                 'Config_Value': 'Could not read configuration file'
             })
-            return
-
-        # Let's normalize the newlines in the config so we only have to deal with one type, \n.
-        # Also, convert the config to lowercase for uniformity
-        device_config = device_config.lower().replace('\r\n', '\n').replace('\r', '\n')
-        # Someone thought it would be a good idea to let some of the lines in the Cisco configurations end
-        #  in whitespace.  Let's try to remove those.
-        device_config = re.sub(r'\s+\n', '\n', device_config)
+            return result, state
+
+        if not normalized:
+            device_config = normalize_config(device_config)
+        state["config"] = device_config
+
+        # Nothing has changed since the last audit, the findings are still the same
+        if previous is not None and previous["template_hash"] != self.template_hash:
+            previous = None
+        if (previous is not None and previous["config"] == device_config and
+                not any(finding['type'] == 'error' for finding in previous["result"])):
+            return previous["result"], previous
+        previous_sections = previous["sections"] if previous is not None else None
+        previous_index = None
         ################################### END Harvesting Running Configuration #######################################
 
         ################################### BEGIN Validating Device Properties #########################################
-        template = self.template
-
-        # Skip any devices that don't match device criteria
-        #  Create a list of custom properties.  This will help us know if we are doing our
-        #   own logic based on the property provided in the template, or looking at something
-        #   that Netbrain gathers
-        custom_properties = [
-            'config'
-        ]
-
-        # Make sure the device matches the possitive global criteria
-        for criteria, pattern in template["device_positive_criteria"].items():
-            # Add logic for 'config' property here
-            if criteria == "config":
+        try:
+            # Make sure the device matches the possitive global criteria
+            for criteria, pattern, compiled in self.device_positive_criteria:
                 # Search the config for the given value
-                if not re.compile(pattern, re.MULTILINE).search(device_config):
-                    self.result.append({
+                if not observed_search(observer, 'device_criteria', '', compiled, device_config, memo,
+                                       self.criteria_literals[pattern]):
+                    result.append({
                         'type': 'unsupported',
                         'section': '',
                         'Template_Value': "{}: {}".format(criteria, pattern),
                         'Config_Value': device_config})
-                    return
-
-        # Make sure the device does not match the negative global criteria
-        for criteria,pattern in template["device_negative_criteria"].items():
-            # Add logic for 'config' property here
-            if criteria == "config":
-                if re.compile(pattern, re.MULTILINE).search(device_config):
-                    self.result.append({
+                    return result, state
+
+            # Make sure the device does not match the negative global criteria
+            for criteria, pattern, compiled in self.device_negative_criteria:
+                if observed_search(observer, 'device_criteria', '', compiled, device_config, memo,
+                                   self.criteria_literals[pattern]):
+                    result.append({
                         'type': 'unsupported',
                         'section': '',
                         'Template_Value': "{}: {}".format(criteria, pattern),
                         'Config_Value': device_config})
-                    return
+                    return result, state
+        except PatternTimeout as error:
+            result.append(error.finding())
+            return result, state
 
         ################################### END Validating Device Properties #########################################
 
+        # Parse the config into blocks once, the rules below only look at the blocks that can match them
+        if config_index is None:
+            config_index = ConfigIndex(device_config)
+            # Keep what the device criteria found, sections often share their patterns
+            config_index.memo.update(memo)
+        memo = config_index.memo
+
         ################################### BEGIN Validating Sections From Template ##################################
-        for section, content in template["sections"].items():
-            # If the device doesn't meet this sections criteria, skip it
-            failed = False
-            # Check for positive criteria
-            for section_property in content["section_positive_criteria"]:
-                temp_property = section_property['property']
-                temp_pattern = section_property['pattern']
-                if temp_property == "config":
-                    if not re.compile(temp_pattern, re.MULTILINE).search(device_config):
-                        failed = True
-
-            # If failed is True, this section is not for this device.  Continue to the next section
-            if failed is True:
-                continue
+        # Decide which sections apply to this device before auditing any blocks, most sections of a template
+        #  meant for many kinds of device won't apply to any one of them
+        applicable = []
+        for content in self.sections:
+            try:
+                applicable.append(self.section_applies(content, device_config, memo, observer))
+            except PatternTimeout as error:
+                applicable.append(error)
 
-            # Check for Negative criteria
-            for section_property in content["section_negative_criteria"]:
-                temp_property = section_property['property']
-                temp_pattern = section_property['pattern']
-                if temp_property == "config":
-                    print("Checking config for {}".format(temp_pattern))
-                    if re.compile(temp_pattern, re.MULTILINE).search(device_config):
-                        print("Negative criteria matched, deviced failed criteria validation.")
-                        failed = True
-
-            # If failed is True, this section is not for this device.  Continue to the next section
-            if failed is True:
+        state["sections"] = []
+        for section_number, content in enumerate(self.sections):
+            section = content["section"]
+            # If the device doesn't meet this sections criteria, skip it
+            if applicable[section_number] is not True:
+                if isinstance(applicable[section_number], PatternTimeout):
+                    result.append(applicable[section_number].finding())
+                state["sections"].append(None)
                 continue
 
             # If we made it here, this section does apply to this device.  Let's audit the device
-            for block in content["blocks"]:
-                rule = block["rule"][0]
-                rule_type = block["rule"][1]
-                sub_rules = block["sub-rules"]
-                # Grab the lists of block criteria
-                block_positive_criteria = block["block_positive_criteria"]
-                block_negative_criteria = block["block_negative_criteria"]
-                # If there is no matching config_block, that's a finding.  Log it to the table and move on
-                config_blocks = re.compile('^((?:{}$)(?:(?:\n .*))*)'.format(rule), re.MULTILINE).findall(device_config)
-                # Decide what to do depending on if the rule is a positive or negative rule
-                if rule_type == True:
-                    if len(config_blocks) == 0:
-                        self.result.append({
-                            'type': 'missing',
-                            'section': section,
-                            'Template_Value': rule,
-                            'Config_Value': ''
-                        })
-                        continue
+            #  Reuse the findings of the last audit for blocks whose config hasn't changed since
+            if previous_sections is not None and previous_sections[section_number] is not None:
+                previous_blocks = previous_sections[section_number]
+                if previous_index is None:
+                    previous_index = ConfigIndex(previous["config"])
+            else:
+                previous_blocks = None
+            section_findings = []
+            for block_number, block in enumerate(content["blocks"]):
+                if (previous_blocks is not None and block["prefix"] and block["single_line"] and
+                        previous_index.block_texts(block["prefix"]) == config_index.block_texts(block["prefix"]) and
+                        # A block that timed out gets another chance
+                        not any(finding['type'] == 'error' for finding in previous_blocks[block_number])):
+                    findings = previous_blocks[block_number]
                 else:
-                    if len(config_blocks) > 0:
-                        for entry in config_blocks:
-                            self.result.append({
-                                'type': 'extra',
-                                'section': section,
-                                'Template_Value': rule,
-                                'Config_Value': entry
-                            })
-                            continue
-
-                for config_block in config_blocks:
-                    # Validate block criteria
-                    # Extract the matched rule from the current config_block
-                    ## If the rule contains capturing groupings, the lookup below will contain a tuple instead of a string.
-                    if debug is True:
-                        print("Rule:\n{}\nConfig Block:\n{}".format(rule,config_block))
-                    if isinstance(config_block, tuple):
-                        config_block = config_block[0]
                     try:
-                        rule_match = re.compile('.*{}.*'.format(rule), re.MULTILINE).findall(config_block)[0]
-                    except:
-                        print("Lookup of rule in config block failed.\nRule:\n{}\nConfig Block:\n{}".format(
-                            rule,
-                            config_block
-                            ))
-                        continue
-
-                    # Validate against section repeat criteria first
-                    failed = False
-                    for section_property in content["section_positive_repeat_criteria"]:
-                        temp_property = section_property['property']
-                        temp_pattern = section_property['pattern']
-                        if temp_property == "config":
-                            if not re.compile(temp_pattern, re.MULTILINE).search(config_block):
-                                failed = True
-                    for section_property in content["section_negative_repeat_criteria"]:
-                        temp_property = section_property['property']
-                        temp_pattern = section_property['pattern']
-                        if temp_property == "config":
-                            if re.compile(temp_pattern, re.MULTILINE).search(config_block):
-                                failed = True
-                    # Now validate the block criteria
-                    for section_property in block["block_positive_criteria"]:
-                        temp_property = section_property['property']
-                        temp_pattern = section_property['pattern']
-                        if temp_property == "config":
-                            if not re.compile(temp_pattern, re.MULTILINE).search(config_block):
-                               failed = True
-                    for section_property in block["block_negative_criteria"]:
-                        temp_property = section_property['property']
-                        temp_pattern = section_property['pattern']
-                        if temp_property == "config":
-                            if re.compile(temp_pattern, re.MULTILINE).search(config_block):
-                                failed = True
-
-                    # If failed is True the configuration block does not meet the criteria, skip the block
-                    if failed is True:
-                        continue
-
-                    # Finally, it is time to audit the interface against this section's template
-                    ## Use block_fail to know if we need to insert the block rule (top level command) into the error
-                    ##   variable or not when a missing sub-rule is found
-                    block_failed = False
-                    error = ''
-                    error_brief = ''
-                    infractions = []
-                    for sub_rule in sub_rules:
-                        sub_rule_orig = sub_rule
-                        sub_rule = sub_rule_orig[0].strip()
-                        sub_rule_type = sub_rule_orig[1]
-                        match = False
-                        infraction = []
-                        for line in config_block.split('\n'):
-                            line = line.strip()
-                            if re.compile('^{}'.format(sub_rule), re.MULTILINE).search(line):
-                                match = True
-                                break
-
-                        if not match == sub_rule_type:
-                            # Determine if this is a rule or a sub-rule mismatch
-                            if block_failed == False:
-                                error += '\n{}'.format(rule_match)
-                                block_failed = True
-                            error += '\n {}'.format(sub_rule)
-                            if sub_rule_type:
-                                if not 'missing' in infractions:
-                                    infractions.append('missing')
-                            else:
-                                if not 'extra' in infractions:
-                                    infractions.append('extra')
-
-                    if block_failed == True:
-                        error = error.strip()
-                        # Strip the first line of the block for the brief value if it is an interface block
-                        self.result.append({
-                            'type': ','.join(infractions),
-                            'section': section,
-                            'Template_Value': error,
-                            'Config_Value' : config_block
-                        })
+                        findings = self.audit_block(section, content, block, config_index, observer)
+                    except PatternTimeout as error:
+                        findings = [error.finding()]
+                section_findings.append(findings)
+                result.extend(findings)
+            state["sections"].append(section_findings)
         ################################### END Validating Sections From Template ##################################
 
         ############################ Final Validation Cleanup ###################################
         # If no infringements found, add row to show that the device complies
-        if len(self.result) == 0:
-            self.result.append({
+        if len(result) == 0:
+            result.append({
                 'type': 'comply',
                 'section': '',
                 'Template_Value': '',
                 'Config_Value' : ''
             })
+
+        return result, state
+
+    def section_applies(self, content, device_config, memo=None, observer=None):
+        # Return True if the device meets the criteria of a compiled section.  The criteria are checked in order,
+        #  and the first one the device fails decides it.
+        section = content["section"]
+        # Check for positive criteria
+        for compiled in content["section_positive_criteria"]:
+            if not observed_search(observer, 'section_criteria', section, compiled, device_config, memo,
+                                   self.criteria_literals[compiled.pattern]):
+                return False
+
+        # Check for Negative criteria
+        for compiled in content["section_negative_criteria"]:
+            if observed_search(observer, 'section_criteria', section, compiled, device_config, memo,
+                               self.criteria_literals[compiled.pattern]):
+                if observer is not None:
+                    observer.message("Negative criteria {} matched, device failed criteria validation for {}.".format(
+                        compiled.pattern, section))
+                return False
+        return True
+
+    def audit_block(self, section, content, block, config_index, observer=None):
+        # Audit the config against a single block of the template, returning the findings for that block
+        findings = []
+        memo = config_index.memo
+        rule = block["rule"]
+        rule_type = block["rule_type"]
+        sub_rules = block["sub-rules"]
+        # If there is no matching config_block, that's a finding.  Log it to the table and move on
+        if observer is None:
+            config_blocks = config_index.find_blocks(block["block_pattern"], block["prefix"])
+        else:
+            observer.evaluating('rule', section, rule)
+            start = time.perf_counter()
+            config_blocks = config_index.find_blocks(block["block_pattern"], block["prefix"])
+            observer.evaluated('rule', section, rule, len(config_blocks), time.perf_counter() - start)
+        # Decide what to do depending on if the rule is a positive or negative rule
+        if rule_type == True:
+            if len(config_blocks) == 0:
+                findings.append({
+                    'type': 'missing',
+                    'section': section,
+                    'Template_Value': rule,
+                    'Config_Value': ''
+                })
+                return findings
+        else:
+            if len(config_blocks) > 0:
+                for entry, lines in config_blocks:
+                    findings.append({
+                        'type': 'extra',
+                        'section': section,
+                        'Template_Value': rule,
+                        'Config_Value': entry
+                    })
+                    continue
+
+        for config_block, lines in config_blocks:
+            # Validate block criteria
+            # Extract the matched rule from the current config_block
+            ## If the rule contains capturing groupings, the lookup below will contain a tuple instead of a string.
+            if observer is not None:
+                observer.message("Rule:\n{}\nConfig Block:\n{}".format(rule, config_block))
+            if isinstance(config_block, tuple):
+                config_block = config_block[0]
+            rule_key = ('rule_lookup', block["rule_pattern"].pattern, config_block)
+            rule_matches = memo.get(rule_key)
+            if rule_matches is None:
+                if observer is not None:
+                    observer.evaluating('rule_lookup', section, rule)
+                    start = time.perf_counter()
+                rule_matches = memo[rule_key] = block["rule_pattern"].findall(config_block)
+                if observer is not None:
+                    observer.evaluated('rule_lookup', section, rule, len(rule_matches), time.perf_counter() - start)
+            if not rule_matches:
+                if observer is not None:
+                    observer.message("Lookup of rule in config block failed.\nRule:\n{}\nConfig Block:\n{}".format(
+                        rule, config_block))
+                continue
+            rule_match = rule_matches[0]
+
+            # Validate against section repeat criteria first
+            failed = False
+            for compiled in content["section_positive_repeat_criteria"]:
+                if not observed_search(observer, 'repeat_criteria', section, compiled, config_block, memo,
+                                       self.criteria_literals[compiled.pattern]):
+                    failed = True
+            for compiled in content["section_negative_repeat_criteria"]:
+                if observed_search(observer, 'repeat_criteria', section, compiled, config_block, memo,
+                                   self.criteria_literals[compiled.pattern]):
+                    failed = True
+            # Now validate the block criteria
+            for compiled in block["block_positive_criteria"]:
+                if not observed_search(observer, 'block_criteria', section, compiled, config_block, memo,
+                                       self.criteria_literals[compiled.pattern]):
+                   failed = True
+            for compiled in block["block_negative_criteria"]:
+                if observed_search(observer, 'block_criteria', section, compiled, config_block, memo,
+                                   self.criteria_literals[compiled.pattern]):
+                    failed = True
+
+            # If failed is True the configuration block does not meet the criteria, skip the block
+            if failed is True:
+                continue
+
+            # == blocks must match the lines of the config block exactly, in order
+            if block["ordered_matcher"] is not None:
+                findings.extend(self.audit_ordered_block(section, block, config_block, lines, rule_match, memo,
+                                                         observer))
+                continue
+
+            # Finally, it is time to audit the interface against this section's template
+            ## Use block_fail to know if we need to insert the block rule (top level command) into the error
+            ##   variable or not when a missing sub-rule is found
+            block_failed = False
+            error = ''
+            infractions = []
+            sub_rule_key = ('sub-rules', block["sub_rule_matcher"].patterns, config_block)
+            matches = memo.get(sub_rule_key)
+            if matches is None:
+                matches = memo[sub_rule_key] = block["sub_rule_matcher"].match(lines, observer, section)
+            for (sub_rule, sub_rule_type, compiled), match in zip(sub_rules, matches):
+                if not match == sub_rule_type:
+                    # Determine if this is a rule or a sub-rule mismatch
+                    if block_failed == False:
+                        error += '\n{}'.format(rule_match)
+                        block_failed = True
+                    error += '\n {}'.format(sub_rule)
+                    if sub_rule_type:
+                        if not 'missing' in infractions:
+                            infractions.append('missing')
+                    else:
+                        if not 'extra' in infractions:
+                            infractions.append('extra')
+
+            if block_failed == True:
+                error = error.strip()
+                # Strip the first line of the block for the brief value if it is an interface block
+                findings.append({
+                    'type': ','.join(infractions),
+                    'section': section,
+                    'Template_Value': error,
+                    'Config_Value' : config_block
+                })
+
+        return findings
+
+
+    def audit_ordered_block(self, section, block, config_block, lines, rule_match, memo, observer=None):
+        # Audit a config block against an == template block, returning a finding for each of the sub-rules that
+        #  are missing, the config lines that are extra and the sub-rules that are out of order
+        matcher = block["ordered_matcher"]
+        key = ('ordered', matcher.patterns, config_block)
+        matched = memo.get(key)
+        if matched is None:
+            matched = memo[key] = matcher.match(lines[1:], observer, section)
+        missing, extra, out_of_order = matched
+        children = lines[1:]
+        findings = []
+        for finding_type, values in (('missing', [matcher.sub_rules[index] for index in missing]),
+                                     ('extra', [children[index] for index in extra]),
+                                     ('out-of-order', [matcher.sub_rules[index] for index in out_of_order])):
+            if values:
+                findings.append({
+                    'type': finding_type,
+                    'section': section,
+                    'Template_Value': ('\n{}'.format(rule_match) + ''.join('\n {}'.format(value)
+                                                                          for value in values)).strip(),
+                    'Config_Value': config_block
+                })
+        return findings
+
+
+class TemplateSet:
+    # Audits one config against many templates, given as a dict of name: template text or CompiledTemplate.  The
+    #  config is normalized and indexed once, and the ConfigIndex remembers every criteria, rule and sub-rule
+    #  evaluation, so patterns the templates have in common are only evaluated once per device.
+    def __init__(self, templates):
+        self.templates = {}
+        for name, template in templates.items():
+            if not isinstance(template, CompiledTemplate):
+                template = CompiledTemplate(template)
+            self.templates[name] = template
+
+    def audit(self, config, observer=None, pattern_timeout=None):
+        # Return the findings of each template, keyed by template name
+        if config and not isinstance(config, ConfigIndex):
+            config = ConfigIndex(normalize_config(config))
+        return {name: template.audit(config, observer, pattern_timeout) for name, template in self.templates.items()}
+
+    def audit_stream(self, source, observer=None, pattern_timeout=None):
+        return self.audit(load_config(source), observer, pattern_timeout)
+
+
+class PyCAudit:
+    def __init__(self, config, template):
+        # The template may be given as text, or as a CompiledTemplate that is shared between many audits
+        if isinstance(template, CompiledTemplate):
+            self.compiled_template = template
+            template = template.template_original
+        else:
+            self.compiled_template = None
+        self.template_original = template
+        self.config = config
+        self.template_string = None
+        self.result = []
+        self.template = self.parse_template()
+
+    def parse_template(self):
+        # Parsing is done by CompiledTemplate, only compile the template if we weren't handed one already
+        if self.compiled_template is None or self.compiled_template.template_original != self.template_original:
+            self.compiled_template = CompiledTemplate(self.template_original)
+        self.template_string = self.compiled_template.template_string
+        return self.compiled_template.template
+
+    def audit(self, observer=None):
+        self.result = self.compiled_template.audit(self.config, observer)
 #
 
-if __name__ == '__main__':
-    my_template = '''# Only audit switches from building 4
+
+# The example template and config from the README, also used as the smallest benchmark case
+SAMPLE_TEMPLATE = '''# Only audit switches from building 4
 ::config::hostname sw_building4_.*
 
 ++GlobalConfig
@@ -415,7 +1505,7 @@ interface .*
  # Must enable portfase
  spanning-tree portfast enable'''
 
-    my_config = '''hostname sw_building4_core
+SAMPLE_CONFIG = '''hostname sw_building4_core
 ...
 some more config lines
 ...
@@ -424,7 +1514,10 @@ interface GigabitEthernet 1/0/1
  switchport mode access
 !
 '''
-    my_audit = PyCAudit(my_config, my_template)
+
+
+if __name__ == '__main__':
+    my_audit = PyCAudit(SAMPLE_CONFIG, SAMPLE_TEMPLATE)
     my_audit.audit()
     print(json.dumps(my_audit.result, indent=2))
     print(json.dumps(my_audit.template, indent=2))
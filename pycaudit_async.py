@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+import urllib.request
+
+from PyCAudit import CompiledTemplate, load_template
+import pycaudit_fleet
+from pycaudit_fleet import audit_device
+
+
+class DirectorySource:
+    # Reads every file in directory matching pattern, or every file matching a glob, as (device_id, config).
+    #  Files are read in threads, up to concurrency at a time, so slow storage doesn't hold up the audits.
+    def __init__(self, source, pattern='*', concurrency=8):
+        self.source = source
+        self.pattern = pattern
+        self.concurrency = concurrency
+
+    def __aiter__(self):
+        devices = pycaudit_fleet.iter_devices(self.source, self.pattern)
+        items = ((device_id, path) for device_id, config, path in devices)
+        return _fetch_all(items, _read_file, self.concurrency)
+
+
+class HTTPSource:
+    # Downloads configs from a backup server, given (device_id, url) pairs or a dict of device_id: url.  A config
+    #  that can't be downloaded is passed on as None, which audit() reports as an unreadable config.
+    def __init__(self, urls, concurrency=8, timeout=30):
+        self.urls = urls
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def __aiter__(self):
+        items = self.urls.items() if isinstance(self.urls, dict) else self.urls
+        return _fetch_all(items, functools.partial(_download, timeout=self.timeout), self.concurrency)
+
+
+def _read_file(path):
+    try:
+        with open(path, encoding='utf-8', errors='replace') as config_file:
+            return config_file.read()
+    except OSError:
+        return None
+
+
+def _download(url, timeout):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read().decode('utf-8', errors='replace')
+    except (OSError, ValueError):
+        return None
+
+
+async def _fetch_all(items, fetch, concurrency):
+    # Run fetch(location) in threads for every (device_id, location), yielding (device_id, config) as each one
+    #  finishes, with no more than concurrency of them running at once
+    loop = asyncio.get_running_loop()
+    items = iter(items)
+    pending = {}
+    try:
+        while True:
+            while len(pending) < concurrency:
+                item = next(items, None)
+                if item is None:
+                    break
+                device_id, location = item
+                pending[loop.run_in_executor(None, fetch, location)] = device_id
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class JSONLinesSink:
+    # Writes each result to output, a path or a file object, as one JSON document per line like the fleet
+    #  command line does
+    def __init__(self, output):
+        if isinstance(output, (str, os.PathLike)):
+            self.output = open(output, 'w', encoding='utf-8')
+            self.owned = True
+        else:
+            self.output = output
+            self.owned = False
+
+    async def send(self, device_id, result):
+        self.output.write(json.dumps({'device': device_id, 'result': result}) + '\n')
+        self.output.flush()
+
+    async def close(self):
+        if self.owned:
+            self.output.close()
+
+
+class FindingStoreSink:
+    # Adds each result to a pycaudit_findings.FindingStore
+    def __init__(self, store):
+        self.store = store
+
+    async def send(self, device_id, result):
+        self.store.add(device_id, result)
+
+    async def close(self):
+        pass
+
+
+def _audit_config(template, device_id, config, timeout, pattern_timeout):
+    return audit_device(template, device_id, config, None, timeout, pattern_timeout)
+
+
+def _audit_in_worker(device_id, config, timeout, pattern_timeout):
+    # The template was handed to the worker process by the pool initializer
+    return _audit_config(pycaudit_fleet._worker_template, device_id, config, timeout, pattern_timeout)
+
+
+async def _iterate(source):
+    # Sources can be async iterators, or plain iterables of (device_id, config)
+    if hasattr(source, '__aiter__'):
+        async for item in source:
+            yield item
+    else:
+        for item in source:
+            yield item
+
+
+async def audit_pipeline(source, template, sinks=(), workers=None, executor=None, queue_size=None, timeout=None,
+                         pattern_timeout=None):
+    # Audit every (device_id, config) from source against template, sending each result to every sink as it
+    #  finishes.  The source is read while earlier configs are being audited, and only queue_size configs are
+    #  ever waiting to be audited, so fetching configs overlaps with auditing without reading the whole source
+    #  up front.  Sinks are objects with async send(device_id, result) and close() methods.
+    #  By default the audits run in a pool of workers processes.  Another executor can be given instead, but
+    #  timeout and pattern_timeout rely on signals, so with a thread pool the audits run without those limits.
+    #  Returns the number of devices audited.
+    if not isinstance(template, CompiledTemplate):
+        template = CompiledTemplate(template)
+    loop = asyncio.get_running_loop()
+    workers = workers or os.cpu_count() or 1
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=pycaudit_fleet._init_worker,
+                                                          initargs=(template,))
+        audit = _audit_in_worker
+    else:
+        audit = functools.partial(_audit_config, template)
+    queue = asyncio.Queue(queue_size or workers * 2)
+    audited = 0
+
+    async def produce():
+        async for device_id, config in _iterate(source):
+            await queue.put((device_id, config))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def consume():
+        nonlocal audited
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            device_id, config = item
+            device_id, result = await loop.run_in_executor(executor, audit, device_id, config, timeout,
+                                                           pattern_timeout)
+            for sink in sinks:
+                await sink.send(device_id, result)
+            audited += 1
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(consume()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for sink in sinks:
+            await sink.close()
+        if own_executor:
+            executor.shutdown(wait=False)
+    return audited
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Audit device configurations fetched from files or a backup server.')
+    parser.add_argument('template', help='template file')
+    parser.add_argument('configs', nargs='?', default=None,
+                        help='directory of configuration files, or a glob matching them')
+    parser.add_argument('--pattern', default='*', help='file name pattern used when configs is a directory')
+    parser.add_argument('--urls', default=None,
+                        help='file with one "device_id url" pair per line, to download the configs from')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--concurrency', type=int, default=8, help='configs fetched at a time')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds allowed to audit a single device')
+    parser.add_argument('--pattern-timeout', type=float, default=None,
+                        help='seconds allowed to evaluate a single template pattern')
+    parser.add_argument('--compiled', default=None,
+                        help='file to keep the compiled template in, so later runs don\'t parse the template again')
+    args = parser.parse_args(argv)
+    if (args.configs is None) == (args.urls is None):
+        parser.error('give either configs or --urls')
+
+    template = load_template(args.template, args.compiled)
+    if args.urls is not None:
+        with open(args.urls, encoding='utf-8') as urls_file:
+            urls = [line.split(None, 1) for line in urls_file if line.strip() and not line.startswith('#')]
+        source = HTTPSource([(device_id, url.strip()) for device_id, url in urls], args.concurrency)
+    else:
+        source = DirectorySource(args.configs, args.pattern, args.concurrency)
+    asyncio.run(audit_pipeline(source, template, [JSONLinesSink(sys.stdout)], args.workers,
+                               timeout=args.timeout, pattern_timeout=args.pattern_timeout))
+
+
+if __name__ == '__main__':
+    main()
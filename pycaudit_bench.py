@@ -0,0 +1,198 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import PyCAudit
+from PyCAudit import CompiledTemplate
+
+
+# Benchmark cases, from the README sample up to a large core switch.  Each case is the arguments given to
+#  generate_config() and generate_template().
+CASES = {
+    'sample': None,
+    'small': {
+        'config': {'interfaces': 48, 'acl_lines': 20, 'global_lines': 50},
+        'template': {'sections': 4, 'blocks': 5, 'sub_rules': 4, 'repeat_criteria': 1}
+    },
+    'medium': {
+        'config': {'interfaces': 400, 'acl_lines': 500, 'global_lines': 300},
+        'template': {'sections': 20, 'blocks': 10, 'sub_rules': 6, 'repeat_criteria': 2}
+    },
+    'large': {
+        'config': {'interfaces': 2000, 'acl_lines': 10000, 'global_lines': 2000},
+        'template': {'sections': 20, 'blocks': 8, 'sub_rules': 8, 'repeat_criteria': 2}
+    }
+}
+
+INTERFACE_TYPES = ['GigabitEthernet', 'TenGigabitEthernet', 'FastEthernet']
+GLOBAL_COMMANDS = [
+    'ntp server 10.{}.{}.1',
+    'logging host 10.{}.{}.2',
+    'snmp-server host 10.{}.{}.3 version 2c public',
+    'ip route 10.{}.{}.0 255.255.255.0 10.0.0.1',
+    'ip name-server 10.{}.{}.53',
+    'username user{}{} privilege 15 secret 5 $1$abcd$efgh'
+]
+
+
+def generate_config(interfaces=48, acl_lines=20, global_lines=50, seed=0):
+    # Build a Cisco style config with the given number of interfaces, access list entries and global commands
+    generator = random.Random(seed)
+    lines = ['hostname sw_building4_{:03d}_core'.format(generator.randint(0, 999)), '!']
+    for number in range(global_lines):
+        lines.append(generator.choice(GLOBAL_COMMANDS).format(number // 256, number % 256))
+    lines.append('!')
+    for number in range(interfaces):
+        lines.append('interface {} {}/0/{}'.format(generator.choice(INTERFACE_TYPES), number // 48 + 1, number % 48 + 1))
+        lines.append(' description {}'.format(generator.choice(['user port', 'uplink to core', 'access point'])))
+        if generator.random() < 0.8:
+            lines.append(' switchport mode access')
+            lines.append(' switchport access vlan {}'.format(generator.choice([1, 10, 20, 30])))
+            lines.append(' spanning-tree portfast')
+        else:
+            lines.append(' switchport mode trunk')
+            lines.append(' switchport trunk allowed vlan 10,20,30')
+            lines.append(' switchport trunk native vlan {}'.format(generator.choice([1, 99])))
+        if generator.random() < 0.1:
+            lines.append(' shutdown')
+        lines.append('!')
+    if acl_lines:
+        lines.append('ip access-list extended BENCHMARK')
+        for number in range(acl_lines):
+            lines.append(' {} {} tcp any host 10.{}.{}.{} eq {}'.format(
+                (number + 1) * 10, generator.choice(['permit', 'deny']), number // 65536 % 256, number // 256 % 256,
+                number % 256, generator.choice([22, 80, 443])))
+        lines.append('!')
+    lines.append('end')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_template(sections=4, blocks=5, sub_rules=4, repeat_criteria=1, seed=0):
+    # Build a template with the given number of sections, blocks per section, sub-rules per interface block and
+    #  &&/|| repeat criteria per section.  Every other section audits interfaces, the rest audit global commands.
+    generator = random.Random(seed)
+    interface_sub_rules = [
+        'description .*', 'switchport mode (trunk|access)', 'switchport access vlan [^1]$', 'spanning-tree portfast',
+        '--shutdown', 'switchport trunk allowed vlan .*', 'switchport trunk native vlan [^1].*',
+        'spanning-tree guard root', 'storm-control broadcast level .*', '--cdp enable', 'no ip redirects'
+    ]
+    repeat_options = ['||config||description .*uplink.*', '||config||shutdown', '&&config&&switchport mode access',
+                      '&&config&&description .*']
+    lines = ['::config::hostname sw_building4_.*', '']
+    for section in range(sections):
+        lines.append('++Section{}'.format(section))
+        if section % 2:
+            for number in range(repeat_criteria):
+                lines.append(repeat_options[number % len(repeat_options)])
+            for block in range(blocks):
+                lines.append(generator.choice(['interface .*', 'interface gigabitethernet .*']))
+                for sub_rule in generator.sample(interface_sub_rules, min(sub_rules, len(interface_sub_rules))):
+                    lines.append(' ' + sub_rule)
+        else:
+            for block in range(blocks):
+                lines.append(generator.choice(GLOBAL_COMMANDS).format(generator.randint(0, 7), generator.randint(0, 255)))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def case_inputs(case):
+    if case is None:
+        return PyCAudit.SAMPLE_CONFIG, PyCAudit.SAMPLE_TEMPLATE
+    return generate_config(**case['config']), generate_template(**case['template'])
+
+
+def best_time(function, repeat):
+    # Fastest of repeat runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(function):
+    # Peak memory allocated while running function, in bytes.  Measured on its own run since tracing slows it down.
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(name, repeat=5, case=None):
+    config, template_text = case_inputs(case if case is not None else CASES[name])
+    template = CompiledTemplate(template_text)
+    config_lines = config.count('\n') + 1
+
+    parse_seconds = best_time(lambda: CompiledTemplate(template_text), repeat)
+    audit_seconds = best_time(lambda: template.audit(config), repeat)
+    return {
+        'case': name,
+        'config_lines': config_lines,
+        'config_bytes': len(config.encode()),
+        'template_lines': template_text.count('\n') + 1,
+        'findings': len(template.audit(config)),
+        'parse_seconds': parse_seconds,
+        'audit_seconds': audit_seconds,
+        'devices_per_second': 1 / audit_seconds if audit_seconds else None,
+        'lines_per_second': config_lines / audit_seconds if audit_seconds else None,
+        'parse_peak_bytes': peak_memory(lambda: CompiledTemplate(template_text)),
+        'audit_peak_bytes': peak_memory(lambda: template.audit(config))
+    }
+
+
+def run(cases=None, repeat=5, custom_case=None):
+    # Run the named cases, or all of them, along with custom_case if one is given
+    results = [run_case(name, repeat) for name in (cases or ([] if custom_case else CASES))]
+    if custom_case:
+        results.append(run_case('custom', repeat, custom_case))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark template parsing and auditing.')
+    parser.add_argument('cases', nargs='*', help='cases to run, from {} (default: all of them)'.format(
+        ', '.join(CASES)))
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each measurement, the fastest is reported')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    # Any of these adds a custom case, sized like the small case apart from the values given
+    custom = parser.add_argument_group('custom case')
+    for option in ['interfaces', 'acl_lines', 'global_lines', 'sections', 'blocks', 'sub_rules', 'repeat_criteria']:
+        custom.add_argument('--' + option.replace('_', '-'), type=int, dest=option)
+    args = parser.parse_args(argv)
+    for name in args.cases:
+        if name not in CASES:
+            parser.error('unknown case {}'.format(name))
+
+    custom_case = None
+    for part in ['config', 'template']:
+        for option in CASES['small'][part]:
+            if getattr(args, option) is not None:
+                if custom_case is None:
+                    custom_case = {key: dict(values) for key, values in CASES['small'].items()}
+                custom_case[part][option] = getattr(args, option)
+
+    report = run(args.cases, args.repeat, custom_case)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from PyCAudit import CompiledTemplate, ConfigIndex, copy_result, normalize_config
+
+
+def cache_key(template, device_config):
+    # Identifies the findings of a parsed template against a normalized config
+    key = hashlib.sha256(template.template_hash.encode())
+    key.update(b'\0')
+    key.update(device_config.encode('utf-8', 'surrogatepass'))
+    return key.hexdigest()
+
+
+def load_result(text):
+    # Read a result written as JSON.  Rules with several groups report their config values as tuples, which JSON
+    #  writes as lists, so they are turned back into tuples to give the same result the audit did.
+    return [{name: tuple(value) if isinstance(value, list) else value for name, value in finding.items()}
+            for finding in json.loads(text)]
+
+
+class LRUResultCache:
+    # Keeps the most recently used results in memory, up to max_entries of them.  If a backend cache is given,
+    #  results that aren't in memory are looked up there, and new results are written through to it.  Results are
+    #  copied going in and out, so callers are free to change the results they are given.
+    def __init__(self, max_entries=10000, backend=None):
+        self.max_entries = max_entries
+        self.backend = backend
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                return copy_result(result)
+        if self.backend is not None:
+            result = self.backend.get(key)
+            if result is not None:
+                self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.backend is not None:
+            self.backend.put(key, result)
+
+    def _remember(self, key, result):
+        result = copy_result(result)
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+
+class SQLiteResultCache:
+    # Keeps results in a SQLite database, so they are kept between runs and can be shared between processes
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return load_result(row[0])
+
+    def put(self, key, result):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)',
+                                    (key, json.dumps(result)))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM results')
+
+    def close(self):
+        self.connection.close()
+
+
+class DirectoryResultCache:
+    # Keeps each result as a JSON file in directory, named after its key
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding='utf-8') as result_file:
+                return load_result(result_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, result):
+        # Write to a temporary file first so a reader never sees a partially written result
+        path = self.path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as result_file:
+            json.dump(result, result_file)
+        os.replace(temp_path, path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class CachedAuditor:
+    # Audits configs against template, reusing the result of any earlier audit of an identical config.  Configs
+    #  are compared after normalization, so they only have to be the same once case, newlines and trailing
+    #  whitespace are ignored.  The cache can be anything with get(key) and put(key, result) methods, and has to
+    #  return results the caller can change, as all the caches here do.
+    def __init__(self, template, cache=None):
+        if not isinstance(template, CompiledTemplate):
+            template = CompiledTemplate(template)
+        self.template = template
+        self.cache = cache if cache is not None else LRUResultCache()
+        self.hits = 0
+        self.misses = 0
+        # Audits can run in several threads at once
+        self.lock = threading.Lock()
+
+    def audit(self, config):
+        # Nothing to normalize, let audit() report the missing config
+        if not config:
+            return self.template.audit(config)
+        # A config from load_config() is already normalized
+        if isinstance(config, ConfigIndex):
+            device_config = config.config
+        else:
+            device_config = normalize_config(config)
+            config = device_config
+        key = cache_key(self.template, device_config)
+        result = self.cache.get(key)
+        if result is not None:
+            with self.lock:
+                self.hits += 1
+            return result
+        with self.lock:
+            self.misses += 1
+        result = self.template.audit_state(config, normalized=True)[0]
+        # Errors such as pattern timeouts may not happen next time, don't remember them
+        if not any(finding['type'] == 'error' for finding in result):
+            self.cache.put(key, result)
+        return result
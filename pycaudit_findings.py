@@ -0,0 +1,498 @@
+import argparse
+import array
+import csv
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# The columns of a finding, in the order they are exported
+COLUMNS = ('device', 'type', 'section', 'Template_Value', 'Config_Value')
+
+
+class Finding:
+    # One finding of a FindingStore.  The values are the store's own interned strings, nothing is copied.
+    __slots__ = ('device', 'type', 'section', 'template_value', 'config_value')
+
+    def __init__(self, device, type, section, template_value, config_value):
+        self.device = device
+        self.type = type
+        self.section = section
+        self.template_value = template_value
+        self.config_value = config_value
+
+    def as_dict(self):
+        # The finding as audit() reports it
+        return {
+            'type': self.type,
+            'section': self.section,
+            'Template_Value': self.template_value,
+            'Config_Value': self.config_value
+        }
+
+    def __repr__(self):
+        return 'Finding({!r}, {!r}, {!r}, {!r}, {!r})'.format(self.device, self.type, self.section,
+                                                           self.template_value, self.config_value)
+
+
+class FindingStore:
+    # Keeps the findings of many devices in compact columns.  Every distinct value (device name, section, template
+    #  value or config block) is stored once in a table of values, and each column is an array of ids into that
+    #  table, so a config block reported by many findings or many devices only costs a few bytes per finding.
+    #  Values are counted as findings refer to them, and freed once no finding does any more.
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+        # How many findings refer to each value, and the ids of the freed values, to be used again
+        self.counts = array.array('I')
+        self.free = []
+        self.columns = {column: array.array('I') for column in COLUMNS}
+        # Where the findings of each device start and end, so a device's result can be looked up again
+        self.devices = {}
+
+    def intern(self, value):
+        # Return the id of value for one more finding referring to it.  Rules with several groups report their
+        #  config values as tuples, which come back from JSON as lists.
+        if isinstance(value, list):
+            value = tuple(value)
+        value_id = self.ids.get(value)
+        if value_id is not None:
+            self.counts[value_id] += 1
+        elif self.free:
+            value_id = self.ids[value] = self.free.pop()
+            self.values[value_id] = value
+            self.counts[value_id] = 1
+        else:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(1)
+        return value_id
+
+    def release(self, value_id):
+        # One finding less refers to the value.  A freed value is kept as '' until its id is used again, exports
+        #  have a string for every id, whether a finding refers to it or not.
+        self.counts[value_id] -= 1
+        if not self.counts[value_id]:
+            del self.ids[self.values[value_id]]
+            self.values[value_id] = ''
+            self.free.append(value_id)
+
+    def add(self, device_id, result):
+        # Add the findings audit() returned for a device, replacing the findings it was added with before
+        if device_id in self.devices:
+            self.remove(device_id)
+        start = len(self)
+        for finding in result:
+            self.columns['device'].append(self.intern(device_id))
+            self.columns['type'].append(self.intern(finding['type']))
+            self.columns['section'].append(self.intern(finding['section']))
+            self.columns['Template_Value'].append(self.intern(finding['Template_Value']))
+            self.columns['Config_Value'].append(self.intern(finding['Config_Value']))
+        self.devices[device_id] = (start, len(self))
+
+    def remove(self, device_id):
+        # Drop the findings of a device, moving the findings of the devices added after it down
+        start, end = self.devices.pop(device_id)
+        for column in self.columns.values():
+            for value_id in column[start:end]:
+                self.release(value_id)
+            del column[start:end]
+        for other, (other_start, other_end) in self.devices.items():
+            if other_start >= end:
+                self.devices[other] = (other_start - (end - start), other_end - (end - start))
+
+    def extend(self, results):
+        # Add (device_id, result) pairs, such as the ones audit_fleet() yields
+        for device_id, result in results:
+            self.add(device_id, result)
+
+    def __len__(self):
+        return len(self.columns['device'])
+
+    def finding(self, row):
+        values = self.values
+        return Finding(*(values[self.columns[column][row]] for column in COLUMNS))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.finding(row)
+
+    def result(self, device_id):
+        # The findings of a device as the list of dicts audit() returned
+        start, end = self.devices[device_id]
+        return [self.finding(row).as_dict() for row in range(start, end)]
+
+    def results(self):
+        # (device_id, result) pairs for every device, in the order they were added
+        for device_id in self.devices:
+            yield device_id, self.result(device_id)
+
+    def write_jsonl(self, output):
+        return write_jsonl(self.results(), output)
+
+    def write_columnar(self, path):
+        # Write the findings as a Parquet file when pyarrow is installed, otherwise as CSV next to it.  Returns the
+        #  path of the file written.
+        if pyarrow is not None:
+            self.write_parquet(path)
+            return path
+        path = os.path.splitext(path)[0] + '.csv'
+        self.write_csv(path)
+        return path
+
+    def write_parquet(self, path):
+        # Each column is written dictionary encoded, using the ids already in the store
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed to write Parquet files')
+        dictionary = pyarrow.array([_text(value) for value in self.values], pyarrow.string())
+        table = pyarrow.table({
+            column: pyarrow.DictionaryArray.from_arrays(pyarrow.array(self.columns[column], pyarrow.uint32()),
+                                                        dictionary)
+            for column in COLUMNS
+        })
+        pyarrow.parquet.write_table(table, path)
+
+    def write_csv(self, path):
+        values = [_text(value) for value in self.values]
+        columns = [self.columns[column] for column in COLUMNS]
+        with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(COLUMNS)
+            for row in range(len(self)):
+                writer.writerow([values[column[row]] for column in columns])
+
+
+def _text(value):
+    # Columnar files need every value to be a string, the tuples of multi-group rules are written as JSON lists
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def write_jsonl(results, output):
+    # Write (device_id, result) pairs to output, a path or a file object, one JSON document per device.  Each
+    #  device is written as soon as it arrives, so results from audit_fleet() are never all held in memory.
+    #  Returns the number of devices written.
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'w', encoding='utf-8') as output_file:
+            return write_jsonl(results, output_file)
+    count = 0
+    for device_id, result in results:
+        output.write(json.dumps({'device': device_id, 'result': result}) + '\n')
+        count += 1
+    return count
+
+
+def read_jsonl(source, store=None):
+    # Load JSON Lines written by write_jsonl() (or the fleet command line) into a FindingStore
+    if store is None:
+        store = FindingStore()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding='utf-8') as source_file:
+            return read_jsonl(source_file, store)
+    store.extend(_iter_jsonl(source))
+    return store
+
+
+def device_status(result):
+    # Sum up the result of a device as 'comply', 'noncompliant', 'unsupported' or 'error'
+    types = set(finding['type'] for finding in result)
+    if 'error' in types:
+        return 'error'
+    if 'unsupported' in types:
+        return 'unsupported'
+    if not types or types == {'comply'}:
+        return 'comply'
+    return 'noncompliant'
+
+
+def split_finding(finding):
+    # Return the rule and the sub-rules of a finding.  Sub-rule findings hold the config line that matched the
+    #  rule followed by the failing sub-rules, one per indented line.  That line names a part of one device's
+    #  config (an interface, an access list) rather than a rule of the template, so their rule is ''.
+    template_value = _text(finding['Template_Value'])
+    if '\n' not in template_value:
+        return template_value, []
+    return '', [line.strip() for line in template_value.split('\n')[1:]]
+
+
+class SQLiteFindingStore:
+    # Keeps the latest findings of every device in a SQLite database, indexed by device, section, rule, sub-rule and
+    #  finding type.  Adding a device replaces whatever was stored for it before, and running totals per rule,
+    #  sub-rule and section are kept up to date as devices are added, so fleet wide counts don't have to scan
+    #  every finding.
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS devices (device TEXT PRIMARY KEY, run TEXT, audited REAL NOT NULL, '
+        'status TEXT NOT NULL, findings INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS devices_status ON devices (status)',
+        'CREATE INDEX IF NOT EXISTS devices_run ON devices (run)',
+        'CREATE TABLE IF NOT EXISTS findings (id INTEGER PRIMARY KEY, device TEXT NOT NULL, section TEXT NOT NULL, '
+        'rule TEXT NOT NULL, type TEXT NOT NULL, template_value TEXT NOT NULL, config_value TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS findings_device ON findings (device)',
+        'CREATE INDEX IF NOT EXISTS findings_section_rule ON findings (section, rule)',
+        'CREATE INDEX IF NOT EXISTS findings_rule ON findings (rule)',
+        'CREATE INDEX IF NOT EXISTS findings_type ON findings (type)',
+        'CREATE TABLE IF NOT EXISTS sub_rules (finding INTEGER NOT NULL, sub_rule TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS sub_rules_finding ON sub_rules (finding)',
+        'CREATE INDEX IF NOT EXISTS sub_rules_sub_rule ON sub_rules (sub_rule)',
+        # Running totals, see _totals()
+        'CREATE TABLE IF NOT EXISTS rule_totals (section TEXT NOT NULL, rule TEXT NOT NULL, type TEXT NOT NULL, '
+        'findings INTEGER NOT NULL, devices INTEGER NOT NULL, PRIMARY KEY (section, rule, type))',
+        'CREATE TABLE IF NOT EXISTS sub_rule_totals (section TEXT NOT NULL, sub_rule TEXT NOT NULL, '
+        'findings INTEGER NOT NULL, devices INTEGER NOT NULL, PRIMARY KEY (section, sub_rule))',
+        'CREATE TABLE IF NOT EXISTS section_totals (section TEXT PRIMARY KEY, findings INTEGER NOT NULL, '
+        'devices INTEGER NOT NULL)',
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    def add(self, device_id, result, run=None):
+        # Store the result of one audit of a device, replacing its previous result
+        self.extend([(device_id, result)], run)
+
+    def extend(self, results, run=None, batch=1000):
+        # Store (device_id, result) pairs, such as the ones audit_fleet() yields, committing every batch devices.
+        #  run names the audit run the results came from.  Returns the number of devices stored.
+        count = 0
+        pending = []
+        for item in results:
+            pending.append(item)
+            if len(pending) >= batch:
+                count += self._store(pending, run)
+                pending = []
+        if pending:
+            count += self._store(pending, run)
+        return count
+
+    def _store(self, results, run):
+        audited = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.cursor()
+            for device_id, result in results:
+                self._remove(cursor, device_id)
+                status = device_status(result)
+                stored = 0
+                for finding in result:
+                    if finding['type'] == 'comply':
+                        continue
+                    rule, sub_rules = split_finding(finding)
+                    cursor.execute('INSERT INTO findings (device, section, rule, type, template_value, config_value) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)',
+                                   (device_id, finding['section'], rule, finding['type'],
+                                    _text(finding['Template_Value']), _text(finding['Config_Value'])))
+                    if sub_rules:
+                        finding_id = cursor.lastrowid
+                        cursor.executemany('INSERT INTO sub_rules (finding, sub_rule) VALUES (?, ?)',
+                                           [(finding_id, sub_rule) for sub_rule in sub_rules])
+                    stored += 1
+                cursor.execute('INSERT OR REPLACE INTO devices (device, run, audited, status, findings) '
+                               'VALUES (?, ?, ?, ?, ?)', (device_id, run, audited, status, stored))
+                self._totals(cursor, device_id, 1)
+        return len(results)
+
+    def _remove(self, cursor, device_id):
+        self._totals(cursor, device_id, -1)
+        cursor.execute('DELETE FROM sub_rules WHERE finding IN (SELECT id FROM findings WHERE device = ?)',
+                       (device_id,))
+        cursor.execute('DELETE FROM findings WHERE device = ?', (device_id,))
+        cursor.execute('DELETE FROM devices WHERE device = ?', (device_id,))
+
+    def _totals(self, cursor, device_id, sign):
+        # Add (sign 1) or take away (sign -1) the findings of a device from the running totals
+        # Each table of totals, the columns it is keyed by and the query giving the device's findings per key
+        totals = [
+            ('rule_totals', ('section', 'rule', 'type'),
+             "SELECT section, rule, type, COUNT(*) FROM findings WHERE device = ? AND rule != '' "
+             'GROUP BY section, rule, type'),
+            ('sub_rule_totals', ('section', 'sub_rule'),
+             'SELECT findings.section, sub_rules.sub_rule, COUNT(*) FROM sub_rules '
+             'JOIN findings ON findings.id = sub_rules.finding WHERE findings.device = ? '
+             'GROUP BY findings.section, sub_rules.sub_rule'),
+            # Only the audited devices count towards the sections, as section_compliance() compares them with the
+            #  number of audited devices
+            ('section_totals', ('section',),
+             'SELECT findings.section, COUNT(*) FROM findings JOIN devices ON devices.device = findings.device '
+             "WHERE findings.device = ? AND devices.status = 'noncompliant' GROUP BY findings.section"),
+        ]
+        for table, key, query in totals:
+            rows = cursor.execute(query, (device_id,)).fetchall()
+            if not rows:
+                continue
+            cursor.executemany(
+                'INSERT INTO {table} ({key}, findings, devices) VALUES ({placeholders}) ON CONFLICT ({key}) '
+                'DO UPDATE SET findings = findings + excluded.findings, devices = devices + excluded.devices'.format(
+                    table=table, key=', '.join(key), placeholders=', '.join('?' * (len(key) + 2))),
+                [row[:-1] + (sign * row[-1], sign) for row in rows])
+            cursor.execute('DELETE FROM {} WHERE devices <= 0'.format(table))
+
+    def remove(self, device_id):
+        with self.lock, self.connection:
+            self._remove(self.connection.cursor(), device_id)
+
+    def _query(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def result(self, device_id):
+        # The findings of a device as the list of dicts audit() returned, or None if the device isn't stored
+        rows = self._query('SELECT status FROM devices WHERE device = ?', (device_id,))
+        if not rows:
+            return None
+        findings = [{'type': finding_type, 'section': section, 'Template_Value': template_value,
+                     'Config_Value': config_value}
+                    for finding_type, section, template_value, config_value in self._query(
+                        'SELECT type, section, template_value, config_value FROM findings WHERE device = ? '
+                        'ORDER BY id', (device_id,))]
+        if not findings:
+            findings.append({'type': 'comply', 'section': '', 'Template_Value': '', 'Config_Value': ''})
+        return findings
+
+    def devices(self, status=None):
+        # The devices stored, optionally only those with the given status
+        if status is None:
+            return [row[0] for row in self._query('SELECT device FROM devices ORDER BY device')]
+        return [row[0] for row in self._query('SELECT device FROM devices WHERE status = ? ORDER BY device',
+                                              (status,))]
+
+    def violating(self, rule, section=None):
+        # The devices with a finding for rule, which can be a rule or a sub-rule
+        section_filter = ' AND findings.section = ?' if section is not None else ''
+        parameters = (rule,) + ((section,) if section is not None else ())
+        return [row[0] for row in self._query(
+            'SELECT device FROM findings WHERE rule = ?' + section_filter + ' UNION '
+            'SELECT findings.device FROM sub_rules JOIN findings ON findings.id = sub_rules.finding '
+            'WHERE sub_rules.sub_rule = ?' + section_filter + ' ORDER BY 1', parameters * 2)]
+
+    def compliance(self):
+        # The number of devices with each status, and the percentage of the audited devices that comply.  Devices
+        #  that weren't audited, because the template doesn't support them or the audit failed, aren't counted.
+        counts = dict(self._query('SELECT status, COUNT(*) FROM devices GROUP BY status'))
+        audited = counts.get('comply', 0) + counts.get('noncompliant', 0)
+        return {
+            'devices': sum(counts.values()),
+            'statuses': counts,
+            'compliance': 100.0 * counts.get('comply', 0) / audited if audited else None
+        }
+
+    def rule_counts(self, section=None, limit=None):
+        # Rules with the most failing devices first, as (section, rule, type, findings, devices).  Findings for
+        #  sub-rules are counted by sub_rule_counts() instead.
+        return self._totals_query('SELECT section, rule, type, findings, devices FROM rule_totals', section, limit)
+
+    def sub_rule_counts(self, section=None, limit=None):
+        # Sub-rules with the most failing devices first, as (section, sub_rule, findings, devices)
+        return self._totals_query('SELECT section, sub_rule, findings, devices FROM sub_rule_totals', section, limit)
+
+    def section_compliance(self):
+        # (section, failing devices, percentage of the audited devices that comply with the section) for every
+        #  section with findings
+        audited = self._query("SELECT COUNT(*) FROM devices WHERE status IN ('comply', 'noncompliant')")[0][0]
+        return [(section, devices, 100.0 * (audited - devices) / audited if audited else None)
+                for section, devices in self._query('SELECT section, devices FROM section_totals '
+                                                    'ORDER BY devices DESC, section')]
+
+    def _totals_query(self, query, section, limit):
+        parameters = []
+        if section is not None:
+            query += ' WHERE section = ?'
+            parameters.append(section)
+        query += ' ORDER BY devices DESC, findings DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+        return self._query(query, parameters)
+
+    def close(self):
+        self.connection.close()
+
+
+def _iter_jsonl(source):
+    for line in source:
+        if line.strip():
+            document = json.loads(line)
+            yield document['device'], document['result']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Store audit results in a SQLite database and query them.')
+    parser.add_argument('database', help='SQLite database file')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    ingest = commands.add_parser('ingest', help='store results written by the fleet command line')
+    ingest.add_argument('results', nargs='+', help='JSON Lines files of results, - for standard input')
+    ingest.add_argument('--run', default=None, help='name of the audit run the results came from')
+    commands.add_parser('summary', help='devices by status and overall compliance')
+    for name, help_text in (('rules', 'rules with the most failing devices'),
+                            ('sub-rules', 'sub-rules with the most failing devices')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--section', default=None, help='only this section')
+        command.add_argument('--limit', type=int, default=20, help='number of rows to show')
+    commands.add_parser('sections', help='compliance with each section')
+    violating = commands.add_parser('devices', help='devices failing a rule or sub-rule, or with a status')
+    violating.add_argument('rule', nargs='?', default=None, help='rule or sub-rule')
+    violating.add_argument('--section', default=None, help='only this section')
+    violating.add_argument('--status', default=None, help='devices with this status instead')
+    show = commands.add_parser('show', help='the stored result of a device')
+    show.add_argument('device')
+    args = parser.parse_args(argv)
+
+    store = SQLiteFindingStore(args.database)
+    out = sys.stdout
+    if args.command == 'ingest':
+        for path in args.results:
+            if path == '-':
+                count = store.extend(_iter_jsonl(sys.stdin), args.run)
+            else:
+                with open(path, encoding='utf-8') as results_file:
+                    count = store.extend(_iter_jsonl(results_file), args.run)
+            sys.stderr.write('stored {} devices from {}\n'.format(count, path))
+    elif args.command == 'summary':
+        compliance = store.compliance()
+        out.write('devices\t{}\n'.format(compliance['devices']))
+        for status, count in sorted(compliance['statuses'].items()):
+            out.write('{}\t{}\n'.format(status, count))
+        if compliance['compliance'] is not None:
+            out.write('compliance\t{:.1f}%\n'.format(compliance['compliance']))
+    elif args.command == 'rules':
+        for section, rule, finding_type, findings, devices in store.rule_counts(args.section, args.limit):
+            out.write('{}\t{}\t{}\t{}\t{!r}\n'.format(devices, findings, finding_type, section, rule))
+    elif args.command == 'sub-rules':
+        for section, sub_rule, findings, devices in store.sub_rule_counts(args.section, args.limit):
+            out.write('{}\t{}\t{}\t{!r}\n'.format(devices, findings, section, sub_rule))
+    elif args.command == 'sections':
+        for section, devices, compliance in store.section_compliance():
+            out.write('{}\t{}\t{}\n'.format(
+                devices, '{:.1f}%'.format(compliance) if compliance is not None else '-', section))
+    elif args.command == 'devices':
+        if args.rule is not None:
+            devices = store.violating(args.rule, args.section)
+        else:
+            devices = store.devices(args.status)
+        for device in devices:
+            out.write(device + '\n')
+    elif args.command == 'show':
+        result = store.result(args.device)
+        if result is None:
+            parser.exit(1, 'no result stored for {}\n'.format(args.device))
+        out.write(json.dumps(result, indent=2) + '\n')
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import collections
+import concurrent.futures
+import glob
+import json
+import os
+import signal
+import sys
+import threading
+
+from PyCAudit import CompiledTemplate, load_config, load_template
+from pycaudit_findings import FindingStore
+
+
+# The compiled template used by the worker processes.  It is handed to each worker once, by the
+#  pool initializer, instead of being pickled along with every chunk of devices.
+_worker_template = None
+
+
+class AuditTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise AuditTimeout()
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def iter_devices(source, pattern='*'):
+    # Turn the source into (device_id, config, path) items.
+    #  A directory yields every file in it matching pattern, a string that isn't a directory is treated as a glob,
+    #  and anything else is expected to be an iterable of (device_id, config) pairs.
+    #  Files are not read here, only their paths are passed along so the workers do the reading.
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            paths = glob.glob(os.path.join(source, pattern))
+        else:
+            paths = glob.glob(source)
+        for path in sorted(paths):
+            if os.path.isfile(path):
+                yield os.path.basename(path), None, path
+    else:
+        for device_id, config in source:
+            yield device_id, config, None
+
+
+def audit_device(template, device_id, config=None, path=None, timeout=None, pattern_timeout=None):
+    # Audit one device, making sure nothing that goes wrong can escape and take down the rest of the batch.
+    #  Errors are reported the same way audit() reports an unreadable config, as an 'error' finding.
+    #  timeout limits the time spent on the whole device, pattern_timeout the time spent on any one pattern.
+    #  Both rely on signals, which can only be handled in the main thread, so off the main thread there is no limit.
+    use_alarm = (timeout and hasattr(signal, 'setitimer') and
+                 threading.current_thread() is threading.main_thread())
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if path is not None:
+            # Stream the file in, so large configs are never held as several full size copies
+            config = load_config(path)
+        result = template.audit(config, pattern_timeout=pattern_timeout)
+    except AuditTimeout:
+        result = [_error_finding('Audit timed out after {} seconds'.format(timeout))]
+    except Exception as e:
+        result = [_error_finding('Audit failed: {}: {}'.format(type(e).__name__, e))]
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+    return device_id, result
+
+
+def _error_finding(message):
+    return {
+        'type': 'error',
+        'section': '',
+        'Template_Value': '',
+        'Config_Value': message
+    }
+
+
+def _audit_chunk(chunk, timeout, pattern_timeout):
+    return [audit_device(_worker_template, device_id, config, path, timeout, pattern_timeout)
+            for device_id, config, path in chunk]
+
+
+def _chunks(devices, chunksize):
+    chunk = []
+    for device in devices:
+        chunk.append(device)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def audit_fleet(source, template, workers=None, chunksize=16, timeout=None, pattern='*', pattern_timeout=None):
+    # Audit every device in source against template, yielding (device_id, result) as each device finishes.
+    #  Results are not kept once they have been yielded, and only a few chunks per worker are ever in flight,
+    #  so neither the configs nor the results of the whole fleet are held in memory at once.
+    #  With workers set to 0 the devices are audited one at a time in this process.
+    if not isinstance(template, CompiledTemplate):
+        template = CompiledTemplate(template)
+    devices = iter_devices(source, pattern)
+
+    if workers == 0:
+        for device_id, config, path in devices:
+            yield audit_device(template, device_id, config, path, timeout, pattern_timeout)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+    chunks = _chunks(devices, chunksize)
+    # Devices that were in flight when a worker died.  They are run again one device per task, and a device that
+    #  is in flight when the pool breaks a second time is only run again with nothing else in flight beside it.
+    retry = collections.deque()
+    suspects = collections.deque()
+    executor = _new_executor(workers, template)
+    in_flight = {}
+    isolated = False
+    try:
+        while True:
+            # Keep the pool busy without reading the whole source up front
+            if suspects and not in_flight:
+                chunk = suspects.popleft()
+                in_flight[executor.submit(_audit_chunk, chunk, timeout, pattern_timeout)] = chunk
+                isolated = True
+            while not isolated and len(in_flight) < max_in_flight:
+                chunk = retry.popleft() if retry else next(chunks, None)
+                if chunk is None:
+                    break
+                in_flight[executor.submit(_audit_chunk, chunk, timeout, pattern_timeout)] = chunk
+            if not in_flight:
+                break
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker died outright (segfault, out of memory, ...) and took the pool with it.  We can't
+                    #  tell which device did it, so narrow it down until the device that kills a worker on its
+                    #  own is found, and report only that one as an error.
+                    broken = True
+                    if isolated:
+                        results = [(chunk[0][0], [_error_finding('Audit worker process terminated unexpectedly')])]
+                    elif len(chunk) > 1:
+                        retry.extend([device] for device in chunk)
+                        continue
+                    else:
+                        suspects.append(chunk)
+                        continue
+                for device_result in results:
+                    yield device_result
+            isolated = False
+
+            if broken:
+                # Every future still in flight was lost with the pool, run them again on a new one
+                executor.shutdown(wait=False)
+                executor = _new_executor(workers, template)
+                for chunk in in_flight.values():
+                    if len(chunk) > 1:
+                        retry.extend([device] for device in chunk)
+                    else:
+                        suspects.append(chunk)
+                in_flight = {}
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _new_executor(workers, template):
+    return concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(template,))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Audit many device configurations against one template.')
+    parser.add_argument('template', help='template file')
+    parser.add_argument('configs', help='directory of configuration files, or a glob matching them')
+    parser.add_argument('--pattern', default='*', help='file name pattern used when configs is a directory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, 0 audits in this process (default: CPU count)')
+    parser.add_argument('--chunksize', type=int, default=16, help='devices sent to a worker at a time')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds allowed to audit a single device')
+    parser.add_argument('--pattern-timeout', type=float, default=None,
+                        help='seconds allowed to evaluate a single template pattern')
+    parser.add_argument('--columnar', default=None,
+                        help='also write every finding to this Parquet file (CSV when pyarrow is not installed)')
+    parser.add_argument('--compiled', default=None,
+                        help='file to keep the compiled template in, so later runs don\'t parse the template again')
+    args = parser.parse_args(argv)
+
+    template = load_template(args.template, args.compiled)
+    # Let the template author know about patterns that are likely to be slow
+    for warning in template.warnings:
+        sys.stderr.write('warning: {} {!r}{}: {}{}\n'.format(
+            warning['kind'], warning['pattern'], ' in section {}'.format(warning['section']) if warning['section'] else '',
+            warning['issue'], ', try {!r}'.format(warning['suggestion']) if warning['suggestion'] else ''))
+
+    # One JSON document per line, written as each device finishes
+    store = FindingStore() if args.columnar else None
+    for device_id, result in audit_fleet(args.configs, template, args.workers, args.chunksize, args.timeout,
+                                         args.pattern, args.pattern_timeout):
+        sys.stdout.write(json.dumps({'device': device_id, 'result': result}) + '\n')
+        sys.stdout.flush()
+        if store is not None:
+            store.add(device_id, result)
+    if store is not None:
+        path = store.write_columnar(args.columnar)
+        sys.stderr.write('wrote {} findings to {}\n'.format(len(store), path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import os
+import pickle
+import urllib.parse
+
+from PyCAudit import CompiledTemplate
+
+
+class MemoryAuditStore:
+    # Keeps the state of the last audit of each device in memory
+    def __init__(self):
+        self.states = {}
+
+    def get(self, device_id):
+        return self.states.get(device_id)
+
+    def put(self, device_id, state):
+        self.states[device_id] = state
+
+    def delete(self, device_id):
+        self.states.pop(device_id, None)
+
+
+class DirectoryAuditStore:
+    # Keeps the state of the last audit of each device in its own file in directory, so it survives restarts
+    #  and can be shared by every process auditing the same devices
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, device_id):
+        return os.path.join(self.directory, urllib.parse.quote(str(device_id), safe='') + '.pickle')
+
+    def get(self, device_id):
+        try:
+            with open(self.path(device_id), 'rb') as state_file:
+                return pickle.load(state_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, device_id, state):
+        # Write to a temporary file first so a reader never sees a partially written state
+        path = self.path(device_id)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as state_file:
+            pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def delete(self, device_id):
+        try:
+            os.remove(self.path(device_id))
+        except FileNotFoundError:
+            pass
+
+
+class IncrementalAuditor:
+    # Re-audits devices using the state saved from their previous audit.  Only the template blocks that look at
+    #  config blocks which changed since then are evaluated again, the findings of every other block are reused.
+    #  Any store with get(device_id) and put(device_id, state) methods can be used to keep the states.
+    def __init__(self, template, store=None):
+        if not isinstance(template, CompiledTemplate):
+            template = CompiledTemplate(template)
+        self.template = template
+        self.store = store if store is not None else MemoryAuditStore()
+
+    def audit(self, device_id, config):
+        previous = self.store.get(device_id)
+        result, state = self.template.audit_state(config, previous)
+        # Don't rewrite the state if nothing changed
+        if state is not previous:
+            self.store.put(device_id, state)
+        return result
@@ -0,0 +1,89 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyCAudit import CompiledTemplate
+
+
+ACL = 'ip access-list extended a'
+
+
+def acl_template(sub_rules):
+    return '++ACL\n=={}\n'.format(ACL) + ''.join('  {}\n'.format(sub_rule) for sub_rule in sub_rules)
+
+
+def acl_config(lines):
+    return '{}\n'.format(ACL) + ''.join(' {}\n'.format(line) for line in lines) + '!\n'
+
+
+class OrderedBlockTest(unittest.TestCase):
+    def audit(self, sub_rules, lines):
+        # The findings of an == block as finding type: the sub-rules or config lines reported
+        findings = {}
+        for finding in CompiledTemplate(acl_template(sub_rules)).audit(acl_config(lines)):
+            if finding['type'] == 'comply':
+                continue
+            self.assertEqual(finding['section'], 'ACL')
+            rule_match, *values = finding['Template_Value'].split('\n')
+            self.assertEqual(rule_match, ACL)
+            findings[finding['type']] = [value.strip() for value in values]
+        return findings
+
+    def test_in_step(self):
+        sub_rules = ['remark management', 'permit ip host 10.1.1.1 any', r'permit ip host 10\.1\.2\.\d+ any',
+                     'deny ip any any log']
+        lines = ['remark management', 'permit ip host 10.1.1.1 any', 'permit ip host 10.1.2.7 any',
+                 'deny ip any any log']
+        self.assertEqual(self.audit(sub_rules, lines), {})
+
+    def test_missing(self):
+        sub_rules = ['permit ip host 10.1.1.1 any', r'permit ip host 10\.1\.1\.\d+ any', 'deny ip any any log']
+        self.assertEqual(self.audit(sub_rules, ['permit ip host 10.1.1.1 any', 'deny ip any any log']),
+                         {'missing': [r'permit ip host 10\.1\.1\.\d+ any']})
+
+    def test_extra(self):
+        sub_rules = ['permit ip host 10.1.1.1 any', 'deny ip any any log']
+        lines = ['permit ip host 10.1.1.1 any', 'permit ip host 10.1.1.2 any', 'permit ip any any',
+                 'deny ip any any log']
+        self.assertEqual(self.audit(sub_rules, lines),
+                         {'extra': ['permit ip host 10.1.1.2 any', 'permit ip any any']})
+
+    def test_dots_match_any_character(self):
+        # Unescaped dots still match whatever character the line has there, escaped ones only a dot
+        sub_rules = ['permit ip host 10.1.1.1 any', r'permit ip host 10\.1\.1\.2 any']
+        lines = ['permit ip host 10x1.1.1 any', 'permit ip host 10.1x1.2 any']
+        self.assertEqual(self.audit(sub_rules, lines),
+                         {'missing': [r'permit ip host 10\.1\.1\.2 any'], 'extra': ['permit ip host 10.1x1.2 any']})
+
+    def test_out_of_order(self):
+        sub_rules = ['permit ip host 10.1.1.1 any', r'permit ip host 10\.1\.1\.\d+ any', 'deny ip any any log']
+        lines = ['deny ip any any log', 'permit ip host 10.1.1.1 any', 'permit ip host 10.1.1.9 any']
+        self.assertEqual(self.audit(sub_rules, lines), {'out-of-order': ['deny ip any any log']})
+
+    def test_reversed(self):
+        sub_rules = [r'permit ip host 10\.1\.{}\.\d+ any'.format(number) for number in range(10)]
+        lines = ['permit ip host 10.1.{}.5 any'.format(number) for number in reversed(range(10))]
+        self.assertEqual(self.audit(sub_rules, lines), {'out-of-order': sub_rules[1:]})
+
+    def test_many_unpaired_sub_rules(self):
+        # The sub-rules for the lines present come after more unpaired sub-rules than were ever tried for a line
+        sub_rules = [r'permit ip host 10\.1\.{}\.\d+ any'.format(number) for number in range(50)]
+        lines = ['permit ip host 10.1.{}.5 any'.format(number) for number in range(40, 50)]
+        self.assertEqual(self.audit(sub_rules, lines), {'missing': sub_rules[:40]})
+        # The same with the lines out of order, and extra lines mixed in
+        lines = lines[4:] + ['permit ip host 10.2.0.1 any'] + lines[:4]
+        self.assertEqual(self.audit(sub_rules, lines),
+                         {'missing': sub_rules[:40], 'extra': ['permit ip host 10.2.0.1 any'],
+                          'out-of-order': sub_rules[40:44]})
+
+    def test_large_literal_block(self):
+        sub_rules = ['permit ip host 10.1.{}.{} any'.format(number // 256, number % 256) for number in range(2000)]
+        lines = sub_rules[:1000] + ['permit ip any any'] + sub_rules[1500:]
+        self.assertEqual(self.audit(sub_rules, lines),
+                         {'missing': sub_rules[1000:1500], 'extra': ['permit ip any any']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import concurrent.futures
+import functools
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyCAudit import SAMPLE_CONFIG, SAMPLE_TEMPLATE, CompiledTemplate
+from pycaudit_async import DirectorySource, HTTPSource, audit_pipeline
+
+
+class ListSink:
+    # Keeps every result it is sent
+    def __init__(self):
+        self.results = {}
+        self.closed = False
+
+    async def send(self, device_id, result):
+        self.results[device_id] = result
+
+    async def close(self):
+        self.closed = True
+
+
+class BlockedSink(ListSink):
+    # Holds up every result until released, so the pipeline backs up behind it
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def send(self, device_id, result):
+        await self.released.wait()
+        await super().send(device_id, result)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class AuditPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.template = CompiledTemplate(SAMPLE_TEMPLATE)
+        self.expected = self.template.audit(SAMPLE_CONFIG)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.devices = ['sw{}'.format(number) for number in range(5)]
+        for device_id in self.devices:
+            with open(os.path.join(self.directory, device_id), 'w', encoding='utf-8') as config_file:
+                config_file.write(SAMPLE_CONFIG)
+
+    def run_pipeline(self, source, sinks, **kwargs):
+        # Audit in threads, worker processes would only slow the tests down
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        return asyncio.run(audit_pipeline(source, self.template, sinks, workers=2, executor=executor, **kwargs))
+
+    def test_directory_source(self):
+        sink = ListSink()
+        self.assertEqual(self.run_pipeline(DirectorySource(self.directory), [sink]), len(self.devices))
+        self.assertEqual(sink.results, {device_id: self.expected for device_id in self.devices})
+        self.assertTrue(sink.closed)
+
+    def test_process_pool(self):
+        sink = ListSink()
+        count = asyncio.run(audit_pipeline(DirectorySource(self.directory), self.template, [sink], workers=2))
+        self.assertEqual(count, len(self.devices))
+        self.assertEqual(sink.results, {device_id: self.expected for device_id in self.devices})
+
+    def test_http_source(self):
+        server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), functools.partial(_QuietHandler, directory=self.directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/{{}}'.format(server.server_address[1])
+        urls = {device_id: url.format(device_id) for device_id in self.devices}
+        urls['missing'] = url.format('missing')
+
+        sink = ListSink()
+        self.assertEqual(self.run_pipeline(HTTPSource(urls, concurrency=2), [sink]), len(urls))
+        for device_id in self.devices:
+            self.assertEqual(sink.results[device_id], self.expected)
+        # A config that can't be downloaded is reported like any unreadable config
+        self.assertEqual(sink.results['missing'], self.template.audit(None))
+
+    def test_timeout_in_threads(self):
+        # Signals can't be used in the executor's threads, the audits run without the limits instead
+        sink = ListSink()
+        self.run_pipeline([('sw0', SAMPLE_CONFIG)], [sink], timeout=5, pattern_timeout=1)
+        self.assertEqual(sink.results, {'sw0': self.expected})
+
+    def test_backpressure(self):
+        produced = []
+
+        async def source():
+            for number in range(50):
+                produced.append(number)
+                yield 'sw{}'.format(number), SAMPLE_CONFIG
+
+        async def run():
+            sink = BlockedSink()
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+            pipeline = asyncio.ensure_future(audit_pipeline(source(), self.template, [sink], workers=1,
+                                                            executor=executor, queue_size=2))
+            await asyncio.sleep(0.5)
+            # One config held by the blocked worker, two queued and one waiting to be queued
+            self.assertLessEqual(len(produced), 4)
+            sink.released.set()
+            count = await pipeline
+            executor.shutdown()
+            return count, sink
+
+        count, sink = asyncio.run(run())
+        self.assertEqual(count, 50)
+        self.assertEqual(len(sink.results), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
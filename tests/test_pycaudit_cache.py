@@ -0,0 +1,67 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyCAudit import CompiledTemplate
+from pycaudit_cache import CachedAuditor, DirectoryResultCache, LRUResultCache, SQLiteResultCache
+
+# The groups of the -- rule make its findings report their config values as tuples
+TEMPLATE = '++NTP\n--(ntp) server (.*)\n++Logging\nlogging host 10.1.1.1\n'
+CONFIG = 'hostname sw0\nntp server 10.1.1.1\nntp server 10.1.1.2\n'
+
+
+class CachedAuditorTest(unittest.TestCase):
+    def setUp(self):
+        self.template = CompiledTemplate(TEMPLATE)
+        self.expected = self.template.audit(CONFIG)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def caches(self):
+        sqlite_cache = SQLiteResultCache(os.path.join(self.directory, 'results.db'))
+        self.addCleanup(sqlite_cache.close)
+        directory_cache = DirectoryResultCache(os.path.join(self.directory, 'results'))
+        return {
+            'memory': LRUResultCache(),
+            'sqlite': sqlite_cache,
+            'directory': directory_cache,
+            'memory over sqlite': LRUResultCache(backend=sqlite_cache),
+            'memory over directory': LRUResultCache(backend=directory_cache)
+        }
+
+    def test_hit_equals_miss(self):
+        self.assertTrue(any(isinstance(finding['Config_Value'], tuple) for finding in self.expected))
+        for name, cache in self.caches().items():
+            with self.subTest(cache=name):
+                cache.clear()
+                auditor = CachedAuditor(self.template, cache)
+                miss = auditor.audit(CONFIG)
+                hit = auditor.audit(CONFIG)
+                self.assertEqual((auditor.hits, auditor.misses), (1, 1))
+                self.assertEqual(miss, self.expected)
+                self.assertEqual(hit, miss)
+
+    def test_backend_hit_equals_miss(self):
+        # A result only in the backend, as in a new process sharing the cache
+        for name in ('sqlite', 'directory'):
+            with self.subTest(cache=name):
+                backend = self.caches()[name]
+                backend.clear()
+                CachedAuditor(self.template, backend).audit(CONFIG)
+                auditor = CachedAuditor(self.template, LRUResultCache(backend=backend))
+                self.assertEqual(auditor.audit(CONFIG), self.expected)
+                self.assertEqual(auditor.hits, 1)
+
+    def test_results_can_be_changed(self):
+        auditor = CachedAuditor(self.template)
+        auditor.audit(CONFIG)[0]['type'] = 'TAMPERED'
+        auditor.audit(CONFIG).append('TAMPERED')
+        self.assertEqual(auditor.audit(CONFIG), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
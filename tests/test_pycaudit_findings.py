@@ -0,0 +1,107 @@
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyCAudit import SAMPLE_CONFIG, SAMPLE_TEMPLATE, CompiledTemplate
+from pycaudit_findings import COLUMNS, FindingStore, SQLiteFindingStore, _text
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COMPLY = [{'type': 'comply', 'section': '', 'Template_Value': '', 'Config_Value': ''}]
+
+
+class FindingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.result = CompiledTemplate(SAMPLE_TEMPLATE).audit(SAMPLE_CONFIG)
+        self.store = FindingStore()
+        self.store.extend([('sw0', self.result), ('sw1', self.result[:2]), ('sw2', COMPLY)])
+
+    def rows(self):
+        # Every finding as the strings the columnar files hold
+        return [[_text(value) for value in (finding.device, finding.type, finding.section, finding.template_value,
+                                            finding.config_value)]
+                for finding in self.store]
+
+    def test_add_again_replaces(self):
+        self.store.add('sw0', self.result[:1])
+        self.assertEqual(list(self.store.results()),
+                         [('sw1', self.result[:2]), ('sw2', COMPLY), ('sw0', self.result[:1])])
+        self.assertEqual(len(self.store), 4)
+
+    def test_removed_values_are_freed(self):
+        changed = [dict(finding, Config_Value='changed') for finding in self.result]
+        values = len(self.store.values)
+        for number in range(10):
+            self.store.add('sw0', [dict(finding, Config_Value=str(number)) for finding in self.result])
+        self.store.add('sw0', changed)
+        # Only the values some finding still refers to are kept, the ids of the others are used again
+        self.assertEqual(set(self.store.ids), set(value for finding in self.store
+                                                  for value in finding.as_dict().values()) | {'sw0', 'sw1', 'sw2'})
+        self.assertLessEqual(len(self.store.values), values + 2)
+        self.assertEqual(self.store.result('sw0'), changed)
+        for device_id in ('sw0', 'sw1', 'sw2'):
+            self.store.remove(device_id)
+        self.assertEqual((len(self.store), self.store.ids), (0, {}))
+
+    def test_write_csv(self):
+        self.store.add('sw1', self.result[1:3])
+        path = os.path.join(self.directory, 'findings.csv')
+        self.store.write_csv(path)
+        with open(path, encoding='utf-8', newline='') as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertEqual(rows, [list(COLUMNS)] + self.rows())
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_write_parquet(self):
+        self.store.add('sw1', self.result[1:3])
+        path = os.path.join(self.directory, 'findings.parquet')
+        self.store.write_parquet(path)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column_names, list(COLUMNS))
+        columns = [table.column(column).to_pylist() for column in COLUMNS]
+        self.assertEqual([list(row) for row in zip(*columns)], self.rows())
+
+
+class SQLiteFindingStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = SQLiteFindingStore(os.path.join(directory, 'findings.db'))
+        self.addCleanup(self.store.close)
+        self.result = CompiledTemplate(SAMPLE_TEMPLATE).audit(SAMPLE_CONFIG)
+        self.sections = sorted(set(finding['section'] for finding in self.result))
+
+    def test_section_compliance_skips_devices_not_audited(self):
+        # A device whose audit failed part way still has findings for the other sections
+        timed_out = self.result + [{'type': 'error', 'section': self.sections[0], 'Template_Value': '',
+                                    'Config_Value': 'timed out'}]
+        self.store.extend([('sw0', self.result), ('sw1', timed_out), ('sw2', COMPLY)])
+        self.assertEqual(self.store.section_compliance(), [(section, 1, 50.0) for section in self.sections])
+        # Once its audit succeeds it is counted
+        self.store.add('sw1', self.result)
+        self.assertEqual(self.store.section_compliance(),
+                         [(section, 2, 100.0 / 3) for section in self.sections])
+        self.store.add('sw1', timed_out)
+        self.store.remove('sw0')
+        self.assertEqual(self.store.section_compliance(), [])
+
+    def test_rule_counts_hold_template_rules(self):
+        self.store.extend([('sw0', self.result), ('sw1', self.result)])
+        rules = set(rule for section, rule, finding_type, findings, devices in self.store.rule_counts())
+        # Sub-rule findings start with the config line that matched the rule, which is no rule of the template
+        self.assertFalse(any(rule.startswith('interface') for rule in rules))
+        self.assertTrue(self.store.sub_rule_counts())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyCAudit import SAMPLE_CONFIG, SAMPLE_TEMPLATE, CompiledTemplate
+from pycaudit_incremental import IncrementalAuditor
+
+
+class IncrementalAuditorTest(unittest.TestCase):
+    def setUp(self):
+        self.template = CompiledTemplate(SAMPLE_TEMPLATE)
+        self.auditor = IncrementalAuditor(self.template)
+
+    def tamper(self, result):
+        result[0]['type'] = 'TAMPERED'
+        result.append('TAMPERED')
+
+    def test_unchanged_config(self):
+        expected = self.template.audit(SAMPLE_CONFIG)
+        self.tamper(self.auditor.audit('sw0', SAMPLE_CONFIG))
+        # The state kept for the device is not the result handed out
+        result = self.auditor.audit('sw0', SAMPLE_CONFIG)
+        self.assertEqual(result, expected)
+        self.tamper(result)
+        self.assertEqual(self.auditor.audit('sw0', SAMPLE_CONFIG), expected)
+
+    def test_changed_config(self):
+        changed = SAMPLE_CONFIG + '\nlogging host 1.1.1.1\n'
+        self.tamper(self.auditor.audit('sw0', SAMPLE_CONFIG))
+        # Blocks whose config didn't change reuse their findings from the state
+        self.assertEqual(self.auditor.audit('sw0', changed), self.template.audit(changed))
+
+
+if __name__ == '__main__':
+    unittest.main()